@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+
+#  a8bench.py - Benchmark of packing toolchain
+#    measures a8pack, relgen and update-atr on a corpus of Atari DOS files
+#    and compares the results with stored baseline
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+#
+# Usage: a8bench.py [options] [run|save|check]
+#  run   - run benchmark and print results (default)
+#  save  - run benchmark and store results as baseline
+#  check - run benchmark and compare with baseline, exit code 1 on regression
+#
+# Corpus is generated (deterministic pseudo random content) except bitmaps
+# from data directory. Hybridize needs built zx0 packer and relocatable
+# unpacker (make tools).
+#
+# Sizes do not depend on the machine, they are kept in tools/bench/baseline.json
+# which is committed. Timing and peak memory do, they are kept in local baseline
+# tools/bench/local.json saved on the machine where the check runs, without it
+# only sizes are checked.
+#
+
+
+import sys
+import os
+import io
+import json
+import time
+import random
+import struct
+import tempfile
+import tracemalloc
+import contextlib
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(os.path.dirname(TOOLS_DIR), "data")
+BASELINE = os.path.join(TOOLS_DIR, "bench", "baseline.json")
+LOCAL_BASELINE = os.path.join(TOOLS_DIR, "bench", "local.json")
+
+sys.path.insert(0, TOOLS_DIR)
+import a8pack
+import relgen
+
+update_atr = a8pack.update_atr
+
+
+#
+# Corpus
+#
+
+def segment(start, data):
+    return struct.pack('<HH', start, start + len(data) - 1) + bytes(data)
+
+
+def run_segment(addr):
+    return segment(0x2E0, struct.pack('<H', addr))
+
+
+def init_segment(addr):
+    return segment(0x2E2, struct.pack('<H', addr))
+
+
+def code_bytes(rnd, base, size, refs=None):
+    """Code like data: opcodes, zero page operands and absolute addresses within the code"""
+    data = bytearray()
+    opcodes = [0xA9, 0x85, 0xA5, 0xC9, 0xD0, 0xF0, 0xE6, 0xA2, 0xA0, 0xE8, 0xC8, 0x60, 0x48, 0x68]
+    absops = [0x20, 0x4C, 0xAD, 0x8D, 0xBD, 0x9D, 0xB9]
+    while len(data) < size:
+        if rnd.random() < 0.3:
+            # absolute addressing, reference within the code
+            target = base + rnd.randrange(size)
+            if refs is not None:
+                refs.append((len(data) + 1, target - base))
+            data += bytes([rnd.choice(absops)]) + struct.pack('<H', target)
+        else:
+            op = rnd.choice(opcodes)
+            data.append(op)
+            if op not in (0x60, 0x48, 0x68, 0xE8, 0xC8):
+                data.append(rnd.randrange(0x40, 0x50))
+    return data[:size]
+
+
+def text_bytes(rnd, size):
+    words = [b"FUJINET", b"CONFIG", b"HOST", b"DEVICE", b"SLOT", b"MOUNT", b"NETWORK", b"WIFI", b"SSID", b"  ", b"\x9b"]
+    data = bytearray()
+    while len(data) < size:
+        data += rnd.choice(words) + b" "
+    return data[:size]
+
+
+def atasm_multi(rnd):
+    """Multi segment file as produced by ATASM: INIT segment ahead of its code, data and RUN"""
+    out = bytearray(b"\xff\xff")
+    out += segment(0x2C1, bytes(range(8)))
+    out += init_segment(0x2400)
+    out += segment(0x2000, code_bytes(rnd, 0x2000, 0x400))
+    out += segment(0x2400, code_bytes(rnd, 0x2400, 0x200))
+    out += segment(0x3000, text_bytes(rnd, 0x1800))
+    out += segment(0x4800, code_bytes(rnd, 0x4800, 0x2000))
+    out += segment(0x7000, bytes(0x800))
+    out += run_segment(0x4800)
+    return bytes(out)
+
+
+def bitmap(name):
+    def make(rnd):
+        with open(os.path.join(DATA_DIR, name), 'rb') as f:
+            data = f.read()
+        return b"\xff\xff" + segment(0x2000, code_bytes(rnd, 0x2000, 0x300)) \
+            + segment(0x8000, data) + run_segment(0x2000)
+    return make
+
+
+def incompressible(rnd):
+    return b"\xff\xff" + segment(0x2000, bytes(rnd.randrange(256) for _ in range(0x2000))) + run_segment(0x2000)
+
+
+CORPUS = [
+    ("atasm-multi", atasm_multi),
+    ("banner", bitmap("banner.dat")),
+    ("banner-vcf", bitmap("banner-vcf.dat")),
+    ("incompressible", incompressible),
+]
+
+
+def relocatable(rnd, size=0x1800, base1=0x1000, base2=0x1201):
+    """Two builds of the same code to different addresses, as input for relgen"""
+    refs = []
+    data1 = code_bytes(rnd, base1, size, refs)
+    data2 = bytearray(data1)
+    offset = base2 - base1
+    for pos, rel in refs:
+        if pos + 1 < size:
+            data2[pos:pos+2] = struct.pack('<H', base2 + rel)
+    return offset, bytes(data1), bytes(data2)
+
+
+def atr_image(loader_sectors=20, loaded_sectors=90):
+    """Empty SD ATR image with directory entries for CLOADER.ZX0 and CONFIG.COM"""
+    sectors = 720
+    atr = bytearray(16 + 128 * sectors)
+    atr[0:6] = struct.pack('<HHH', 0x0296, sectors * 128 // 16, 128)
+    entries = [(b"CLOADER ZX0", loader_sectors, 4), (b"CONFIG  COM", loaded_sectors, 4 + loader_sectors)]
+    for i, (name, count, ssn) in enumerate(entries):
+        ofs = 16 + 128 * 360 + 16 * i
+        atr[ofs:ofs+16] = struct.pack('<BHH', 0x42, count, ssn) + name
+    return atr
+
+
+#
+# Measurements
+#
+
+def best_time(func, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - t
+        best = elapsed if best is None or elapsed < best else best
+    return best, result
+
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def can_hybridize():
+    unpacker = a8pack.packers[a8pack.PACK_ZX0][2][0]
+    return os.path.exists(os.path.join(TOOLS_DIR, "pack", "a8", unpacker)) \
+        and os.path.exists(os.path.join(TOOLS_DIR, "pack", "zx0"))
+
+
+def bench_file(name, data, tmpdir, repeat):
+    fin = os.path.join(tmpdir, name + ".com")
+    fout = os.path.join(tmpdir, name + "-out.com")
+    with open(fin, 'wb') as f:
+        f.write(data)
+    r = {'bytes': len(data)}
+    t, obj = best_time(lambda: a8pack.AtariDosObject().load(fin), repeat)
+    r['load'] = t
+    t, obj = best_time(lambda: obj.fix_init_order(), repeat)
+    r['fix_init_order'] = t
+    t, packed = best_time(lambda: obj.pack(a8pack.PACK_ZX0), repeat)
+    r['pack'] = t
+    r['packed_bytes'] = packed.size()
+    out = packed
+    if can_hybridize():
+        t, out = best_time(lambda: packed.hybridize(), repeat)
+        r['hybridize'] = t
+        r['hybrid_bytes'] = out.size()
+    t, _ = best_time(lambda: out.save(fout), repeat)
+    r['save'] = t
+    r['ratio'] = r['packed_bytes'] / r['bytes']
+    pipeline_time = sum(r[p] for p in ('load', 'fix_init_order', 'pack', 'hybridize', 'save') if p in r)
+    r['throughput'] = r['bytes'] / pipeline_time
+
+    def pipeline():
+        o = a8pack.AtariDosObject().load(fin).fix_init_order().pack(a8pack.PACK_ZX0)
+        if can_hybridize():
+            o = o.hybridize()
+        o.save(fout)
+    r['peak_memory'] = peak_memory(pipeline)
+    return r
+
+
+def bench_relgen(rnd, repeat):
+    offset, data1, data2 = relocatable(rnd)
+    t, reltab = best_time(lambda: relgen.gen_relocation(None, 0x1000, offset, data1, data2), repeat)
+    return {
+        'bytes': len(data1),
+        'gen_relocation': t,
+        'table_bytes': len(reltab),
+        'throughput': len(data1) / t,
+        'peak_memory': peak_memory(lambda: relgen.gen_relocation(None, 0x1000, offset, data1, data2)),
+    }
+
+
+def bench_update_atr(tmpdir, repeat):
+    atrfn = os.path.join(tmpdir, "bench.atr")
+    atr = atr_image()
+
+    def patch():
+        with open(atrfn, 'wb') as f:
+            f.write(atr)
+        argv = sys.argv
+        sys.argv = ["update-atr.py", atrfn, "cloader.zx0", "config.com"]
+        try:
+            update_atr.main()
+        finally:
+            sys.argv = argv
+
+    t, _ = best_time(patch, repeat)
+    return {'bytes': len(atr), 'update_atr': t, 'throughput': len(atr) / t}
+
+
+def run_bench(repeat):
+    results = {}
+    rnd = random.Random(0x2021)
+    with tempfile.TemporaryDirectory() as tmpdir, contextlib.redirect_stdout(io.StringIO()):
+        for name, make in CORPUS:
+            results[name] = bench_file(name, make(rnd), tmpdir, repeat)
+        results['relgen'] = bench_relgen(rnd, repeat)
+        results['update-atr'] = bench_update_atr(tmpdir, repeat)
+    return results
+
+
+#
+# Reporting
+#
+
+TIME_KEYS = ('load', 'fix_init_order', 'pack', 'hybridize', 'save', 'gen_relocation', 'update_atr')
+SIZE_KEYS = ('packed_bytes', 'hybrid_bytes', 'table_bytes')
+# machine independent results, stored in committed baseline
+BASELINE_KEYS = ('bytes', 'ratio') + SIZE_KEYS
+
+
+def print_results(results):
+    for name, r in results.items():
+        times = "  ".join(f"{k} {1000*r[k]:.2f}ms" for k in TIME_KEYS if k in r)
+        sizes = "  ".join(f"{k} {r[k]}" for k in SIZE_KEYS if k in r)
+        print(f"{name}: {r['bytes']} bytes  {times}")
+        extra = f"  ratio {100*r['ratio']:.1f}%" if 'ratio' in r else ""
+        mem = f"  peak memory {r['peak_memory']/1024:.1f}KB" if 'peak_memory' in r else ""
+        print(f"    {sizes}{extra}  throughput {r['throughput']/1024:.1f}KB/s{mem}")
+
+
+def compare(results, baseline, time_threshold, size_threshold, time_floor):
+    """Return list of regressions, time/memory beyond time_threshold %, sizes beyond size_threshold %
+
+    Slowdown below time_floor seconds is ignored, very short times are too noisy.
+    """
+    regressions = []
+    for name, base in baseline.items():
+        r = results.get(name)
+        if r is None:
+            regressions.append(f"{name}: missing in results")
+            continue
+        for k in TIME_KEYS + ('peak_memory',):
+            floor = time_floor if k in TIME_KEYS else 0
+            if k in base and k in r and r[k] > base[k] * (1 + time_threshold / 100) and r[k] - base[k] > floor:
+                regressions.append(f"{name}: {k} {r[k]:.6g} > baseline {base[k]:.6g} (+{100*(r[k]/base[k]-1):.1f}%)")
+        for k in SIZE_KEYS:
+            if k in base and k in r and r[k] > base[k] * (1 + size_threshold / 100):
+                regressions.append(f"{name}: {k} {r[k]} > baseline {base[k]}")
+    return regressions
+
+
+def main():
+    o_repeat = 5
+    o_time = 25.0
+    o_size = 0.0
+    o_floor = 1.0
+    o_baseline = BASELINE
+    o_local = LOCAL_BASELINE
+    action = None
+
+    args = sys.argv[1:]
+    while args:
+        arg = args.pop(0)
+        if arg in ('-n', '-t', '-s', '-m', '-b', '-l'):
+            if not args:
+                print(f'Option {arg} requires value')
+                sys.exit(1)
+            value = args.pop(0)
+            try:
+                if arg == '-n':
+                    o_repeat = max(1, int(value))
+                elif arg == '-t':
+                    o_time = float(value)
+                elif arg == '-s':
+                    o_size = float(value)
+                elif arg == '-m':
+                    o_floor = float(value)
+                elif arg == '-l':
+                    o_local = value
+                else:
+                    o_baseline = value
+            except ValueError:
+                print(f'Bad value for option {arg}: "{value}"')
+                sys.exit(1)
+        elif arg == '-h':
+            print_help()
+            sys.exit(0)
+        elif arg[0] == '-':
+            print(f'Unknown option: "{arg}"')
+            sys.exit(1)
+        elif action is None and arg in ('run', 'save', 'check'):
+            action = arg
+        else:
+            print(f'Extra parameter: "{arg}"')
+            sys.exit(1)
+
+    if not can_hybridize():
+        print("Packer or relocatable unpacker not found, run \"make tools\" to benchmark hybridize")
+
+    results = run_bench(o_repeat)
+    print_results(results)
+
+    if action == 'save':
+        sizes = {name: {k: r[k] for k in BASELINE_KEYS if k in r} for name, r in results.items()}
+        for fn, data in ((o_baseline, sizes), (o_local, results)):
+            os.makedirs(os.path.dirname(os.path.abspath(fn)), exist_ok=True)
+            with open(fn, 'w') as f:
+                json.dump(data, f, indent=1, sort_keys=True)
+                f.write('\n')
+        print(f'Baseline saved to "{o_baseline}", timing and memory to "{o_local}"')
+
+    elif action == 'check':
+        try:
+            with open(o_baseline, 'r') as f:
+                baseline = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f'Failed to read baseline "{o_baseline}"')
+            print(e)
+            sys.exit(1)
+        try:
+            with open(o_local, 'r') as f:
+                local = json.load(f)
+        except (OSError, ValueError):
+            print(f'\nNo local baseline "{o_local}", timing and memory are not checked'
+                ', use "a8bench.py save" before a change')
+            local = {}
+        # sizes from committed baseline, timing and memory from local one
+        baseline = {name: dict({k: v for k, v in local.get(name, {}).items() if k not in BASELINE_KEYS}, **base)
+            for name, base in baseline.items()}
+        regressions = compare(results, baseline, o_time, o_size, o_floor / 1000)
+        if regressions:
+            print("\nRegressions:")
+            for r in regressions:
+                print(f"  {r}")
+            sys.exit(1)
+        print("\nNo regressions.")
+
+
+def print_help():
+    print("""Benchmark of packing toolchain (a8pack, relgen, update-atr).
+Usage: a8bench.py [options] [run|save|check]
+  run     Run benchmark and print results (default)
+  save    Run benchmark and store results as baseline, sizes to committed
+          baseline, timing and memory to local baseline of this machine
+  check   Run benchmark, fail if results are worse than baseline
+Options:
+  -n N    Repeat each measurement N times, best time is used (default 5)
+  -t PCT  Allowed slowdown and peak memory growth in percent (default 25)
+  -s PCT  Allowed growth of packed sizes in percent (default 0)
+  -m MS   Ignore slowdown below MS milliseconds (default 1)
+  -b FILE Baseline file (default tools/bench/baseline.json)
+  -l FILE Local baseline with timing and memory (default tools/bench/local.json)
+  -h      Print this help
+""")
+
+
+if __name__ == '__main__':
+    main()
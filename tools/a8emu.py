@@ -0,0 +1,1233 @@
+#!/usr/bin/env python3
+
+#  a8emu.py - Emulated SIO harness for the boot and config loaders
+#    runs boot loader, config loader and loaded program on emulated 6502,
+#    POKEY serial port and SIO disk drive, reports loading time
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+#
+# What is emulated:
+#  - NMOS 6502, documented opcodes, cycle counts with page crossing penalties
+#  - POKEY serial port at register level: SEROUT, SERIN, IRQEN/IRQST, SKSTAT,
+#    SKREST, AUDF3/AUDF4 baud rate, data input overrun and framing errors,
+#    so HISIO code runs unmodified
+#  - SIO disk drive answering read sector, status, get high speed index and
+#    read burst of sectors (FujiNet stand-in, one data frame for up to 16
+#    sectors), with configurable ACK, COMPLETE and data frame delays
+#  - OS: boot of sectors 1-3, SIOV (standard speed, on DCB level), VBI with
+#    RTCLOK, XITVBV, serial port IRQs dispatched via VIMIRQ; no ROM code,
+#    no ANTIC DMA cycle stealing
+#
+# First visible output is the first VBI stage 2 (OS copies SDMCTL to DMACTL)
+# with SDMCTL set, i.e. when the display list of config loader is shown.
+#
+# Loading is finished when the program is started via JMP ($02E0) the given
+# number of times (boot loader starts config loader, config loader starts
+# the loaded program).
+#
+
+
+import sys
+import json
+import struct
+from collections import deque
+
+
+CPU_CLOCK = 1789773             # NTSC, cycles per second
+SCANLINE = 114                  # cycles per scan line
+FRAME_NTSC = 262 * SCANLINE
+FRAME_PAL = 312 * SCANLINE
+VBI_LINE = 248                  # VCOUNT*2 when VBI starts
+
+# OS entry points and variables
+SIOV = 0xE459
+SETVBV = 0xE45C
+SYSVBV = 0xE45F
+XITVBV = 0xE462
+OSNMI = 0xC100                  # NMI handler of emulated OS
+OSIRQ = 0xC030                  # IRQ handler of emulated OS, JMP (VIMIRQ)
+OSIRQDEF = 0xC040               # default VIMIRQ handler, acknowledges IRQ
+RTCLOK = 0x12
+SDMCTL = 0x22F
+CRITIC = 0x42
+VVBLKI = 0x222
+VVBLKD = 0x224
+VIMIRQ = 0x216
+RUNAD = 0x2E0
+DOSINI = 0x0C
+DCB = 0x300
+
+STD_DIVISOR = 0x28              # POKEY divisor for 19200 baud
+BURST_CMD = 0x72                # read burst of sectors, see src/cloader-hi.src
+
+FLAG_C = 0x01
+FLAG_Z = 0x02
+FLAG_I = 0x04
+FLAG_D = 0x08
+FLAG_B = 0x10
+FLAG_V = 0x40
+FLAG_N = 0x80
+
+
+def byte_cycles(divisor):
+    """CPU cycles to transfer one byte (start bit, 8 data bits, stop bit)"""
+    return 20 * (divisor + 7)
+
+
+def us(t):
+    """Microseconds to CPU cycles"""
+    return t * CPU_CLOCK // 1000000
+
+
+def sio_checksum(data):
+    s = 0
+    for b in data:
+        s += b
+        s = (s & 0xFF) + (s >> 8)
+    return s
+
+
+class CPU6502:
+    """NMOS 6502, documented instructions"""
+
+    def __init__(self, read, write):
+        self.read = read
+        self.write = write
+        self.a = 0
+        self.x = 0
+        self.y = 0
+        self.sp = 0xFF
+        self.p = 0x24
+        self.pc = 0
+        self.cycles = 0
+        self.ops = [None] * 256
+        self.build_ops()
+
+
+    # stack
+
+    def push(self, v):
+        self.write(0x100 + self.sp, v)
+        self.sp = (self.sp - 1) & 0xFF
+
+
+    def pull(self):
+        self.sp = (self.sp + 1) & 0xFF
+        return self.read(0x100 + self.sp)
+
+
+    def push_word(self, w):
+        self.push(w >> 8)
+        self.push(w & 0xFF)
+
+
+    def pull_word(self):
+        lo = self.pull()
+        return lo | self.pull() << 8
+
+
+    def nmi(self):
+        self.push_word(self.pc)
+        self.push(self.p & ~FLAG_B | 0x20)
+        self.p |= FLAG_I
+        self.pc = self.read(0xFFFA) | self.read(0xFFFB) << 8
+        self.cycles += 7
+
+
+    def irq(self):
+        self.push_word(self.pc)
+        self.push(self.p & ~FLAG_B | 0x20)
+        self.p |= FLAG_I
+        self.pc = self.read(0xFFFE) | self.read(0xFFFF) << 8
+        self.cycles += 7
+
+
+    def rts(self):
+        self.pc = (self.pull_word() + 1) & 0xFFFF
+
+
+    def set_nz(self, v):
+        self.p = (self.p & 0x7D) | (v & 0x80) | (0 if v else FLAG_Z)
+
+
+    # addressing modes, return effective address
+
+    def fetch(self):
+        v = self.read(self.pc)
+        self.pc = (self.pc + 1) & 0xFFFF
+        return v
+
+
+    def fetch_word(self):
+        lo = self.fetch()
+        return lo | self.fetch() << 8
+
+
+    def am_zp(self):
+        return self.fetch()
+
+
+    def am_zpx(self):
+        return (self.fetch() + self.x) & 0xFF
+
+
+    def am_zpy(self):
+        return (self.fetch() + self.y) & 0xFF
+
+
+    def am_abs(self):
+        return self.fetch_word()
+
+
+    def am_abx(self, penalty):
+        base = self.fetch_word()
+        addr = (base + self.x) & 0xFFFF
+        if penalty and (base ^ addr) & 0xFF00:
+            self.cycles += 1
+        return addr
+
+
+    def am_aby(self, penalty):
+        base = self.fetch_word()
+        addr = (base + self.y) & 0xFFFF
+        if penalty and (base ^ addr) & 0xFF00:
+            self.cycles += 1
+        return addr
+
+
+    def am_izx(self):
+        zp = (self.fetch() + self.x) & 0xFF
+        return self.read(zp) | self.read((zp + 1) & 0xFF) << 8
+
+
+    def am_izy(self, penalty):
+        zp = self.fetch()
+        base = self.read(zp) | self.read((zp + 1) & 0xFF) << 8
+        addr = (base + self.y) & 0xFFFF
+        if penalty and (base ^ addr) & 0xFF00:
+            self.cycles += 1
+        return addr
+
+
+    def build_ops(self):
+        ops = self.ops
+        # addressing mode -> (opcode offset in ALU group, address function)
+        modes = {
+            'izx': (0x01, lambda p: self.am_izx()),
+            'zp':  (0x05, lambda p: self.am_zp()),
+            'imm': (0x09, None),
+            'abs': (0x0D, lambda p: self.am_abs()),
+            'izy': (0x11, lambda p: self.am_izy(p)),
+            'zpx': (0x15, lambda p: self.am_zpx()),
+            'aby': (0x19, lambda p: self.am_aby(p)),
+            'abx': (0x1D, lambda p: self.am_abx(p)),
+        }
+        cycles = {'izx': 6, 'zp': 3, 'imm': 2, 'abs': 4, 'izy': 5, 'zpx': 4, 'aby': 4, 'abx': 4}
+
+        def alu(base, func):
+            for mode, (offset, am) in modes.items():
+                ops[base + offset - 1] = self.make_read(func, am, cycles[mode])
+
+        alu(0x61, self.op_adc)
+        alu(0x21, self.op_and)
+        alu(0xC1, self.op_cmp)
+        alu(0x41, self.op_eor)
+        alu(0xA1, self.op_lda)
+        alu(0x01, self.op_ora)
+        alu(0xE1, self.op_sbc)
+        # STA, no immediate mode, no page crossing penalty
+        for mode, (offset, am) in modes.items():
+            if mode != 'imm':
+                c = {'izx': 6, 'zp': 3, 'abs': 4, 'izy': 6, 'zpx': 4, 'aby': 5, 'abx': 5}[mode]
+                ops[0x80 + offset] = self.make_store(lambda: self.a, am, c)
+
+        zp = modes['zp'][1]
+        zpx = modes['zpx'][1]
+        abs_ = modes['abs'][1]
+        abx = modes['abx'][1]
+        aby = modes['aby'][1]
+        zpy = lambda p: self.am_zpy()
+
+        # read-modify-write
+        for base, func in ((0x00, self.op_asl), (0x20, self.op_rol), (0x40, self.op_lsr), (0x60, self.op_ror),
+                (0xC0, self.op_dec), (0xE0, self.op_inc)):
+            ops[base + 0x06] = self.make_rmw(func, zp, 5)
+            ops[base + 0x16] = self.make_rmw(func, zpx, 6)
+            ops[base + 0x0E] = self.make_rmw(func, abs_, 6)
+            ops[base + 0x1E] = self.make_rmw(func, abx, 7)
+        for base, func in ((0x00, self.op_asl), (0x20, self.op_rol), (0x40, self.op_lsr), (0x60, self.op_ror)):
+            ops[base + 0x0A] = self.make_acc(func)
+
+        # X, Y loads, stores and compares
+        ops[0xA2] = self.make_read(self.op_ldx, None, 2)
+        ops[0xA6] = self.make_read(self.op_ldx, zp, 3)
+        ops[0xB6] = self.make_read(self.op_ldx, zpy, 4)
+        ops[0xAE] = self.make_read(self.op_ldx, abs_, 4)
+        ops[0xBE] = self.make_read(self.op_ldx, aby, 4)
+        ops[0xA0] = self.make_read(self.op_ldy, None, 2)
+        ops[0xA4] = self.make_read(self.op_ldy, zp, 3)
+        ops[0xB4] = self.make_read(self.op_ldy, zpx, 4)
+        ops[0xAC] = self.make_read(self.op_ldy, abs_, 4)
+        ops[0xBC] = self.make_read(self.op_ldy, abx, 4)
+        ops[0x86] = self.make_store(lambda: self.x, zp, 3)
+        ops[0x96] = self.make_store(lambda: self.x, zpy, 4)
+        ops[0x8E] = self.make_store(lambda: self.x, abs_, 4)
+        ops[0x84] = self.make_store(lambda: self.y, zp, 3)
+        ops[0x94] = self.make_store(lambda: self.y, zpx, 4)
+        ops[0x8C] = self.make_store(lambda: self.y, abs_, 4)
+        ops[0xE0] = self.make_read(self.op_cpx, None, 2)
+        ops[0xE4] = self.make_read(self.op_cpx, zp, 3)
+        ops[0xEC] = self.make_read(self.op_cpx, abs_, 4)
+        ops[0xC0] = self.make_read(self.op_cpy, None, 2)
+        ops[0xC4] = self.make_read(self.op_cpy, zp, 3)
+        ops[0xCC] = self.make_read(self.op_cpy, abs_, 4)
+        ops[0x24] = self.make_read(self.op_bit, zp, 3)
+        ops[0x2C] = self.make_read(self.op_bit, abs_, 4)
+
+        # branches
+        for opcode, mask, value in ((0x10, FLAG_N, 0), (0x30, FLAG_N, FLAG_N), (0x50, FLAG_V, 0),
+                (0x70, FLAG_V, FLAG_V), (0x90, FLAG_C, 0), (0xB0, FLAG_C, FLAG_C),
+                (0xD0, FLAG_Z, 0), (0xF0, FLAG_Z, FLAG_Z)):
+            ops[opcode] = self.make_branch(mask, value)
+
+        # implied
+        def implied(opcode, func):
+            def op():
+                func()
+                self.cycles += 2
+            ops[opcode] = op
+
+        def flag(opcode, mask, value):
+            def f():
+                self.p = (self.p & ~mask) | value
+            implied(opcode, f)
+
+        flag(0x18, FLAG_C, 0)
+        flag(0x38, FLAG_C, FLAG_C)
+        flag(0x58, FLAG_I, 0)
+        flag(0x78, FLAG_I, FLAG_I)
+        flag(0xB8, FLAG_V, 0)
+        flag(0xD8, FLAG_D, 0)
+        flag(0xF8, FLAG_D, FLAG_D)
+
+        def tax(): self.x = self.a; self.set_nz(self.x)
+        def tay(): self.y = self.a; self.set_nz(self.y)
+        def txa(): self.a = self.x; self.set_nz(self.a)
+        def tya(): self.a = self.y; self.set_nz(self.a)
+        def tsx(): self.x = self.sp; self.set_nz(self.x)
+        def txs(): self.sp = self.x
+        def inx(): self.x = (self.x + 1) & 0xFF; self.set_nz(self.x)
+        def iny(): self.y = (self.y + 1) & 0xFF; self.set_nz(self.y)
+        def dex(): self.x = (self.x - 1) & 0xFF; self.set_nz(self.x)
+        def dey(): self.y = (self.y - 1) & 0xFF; self.set_nz(self.y)
+        def nop(): pass
+        for opcode, func in ((0xAA, tax), (0xA8, tay), (0x8A, txa), (0x98, tya), (0xBA, tsx), (0x9A, txs),
+                (0xE8, inx), (0xC8, iny), (0xCA, dex), (0x88, dey), (0xEA, nop)):
+            implied(opcode, func)
+
+        def pha():
+            self.push(self.a)
+            self.cycles += 3
+        def php():
+            self.push(self.p | FLAG_B | 0x20)
+            self.cycles += 3
+        def pla():
+            self.a = self.pull()
+            self.set_nz(self.a)
+            self.cycles += 4
+        def plp():
+            self.p = self.pull() & ~FLAG_B | 0x20
+            self.cycles += 4
+        def jmp():
+            self.pc = self.fetch_word()
+            self.cycles += 3
+        def jmp_ind():
+            ptr = self.fetch_word()
+            # NMOS bug, pointer does not cross page
+            self.pc = self.read(ptr) | self.read((ptr & 0xFF00) | ((ptr + 1) & 0xFF)) << 8
+            self.cycles += 5
+        def jsr():
+            addr = self.fetch_word()
+            self.push_word((self.pc - 1) & 0xFFFF)
+            self.pc = addr
+            self.cycles += 6
+        def rts():
+            self.rts()
+            self.cycles += 6
+        def rti():
+            self.p = self.pull() & ~FLAG_B | 0x20
+            self.pc = self.pull_word()
+            self.cycles += 6
+        def brk():
+            self.push_word((self.pc + 1) & 0xFFFF)
+            self.push(self.p | FLAG_B | 0x20)
+            self.p |= FLAG_I
+            self.pc = self.read(0xFFFE) | self.read(0xFFFF) << 8
+            self.cycles += 7
+        ops[0x48] = pha
+        ops[0x08] = php
+        ops[0x68] = pla
+        ops[0x28] = plp
+        ops[0x4C] = jmp
+        ops[0x6C] = jmp_ind
+        ops[0x20] = jsr
+        ops[0x60] = rts
+        ops[0x40] = rti
+        ops[0x00] = brk
+
+
+    def make_read(self, func, am, c):
+        if am is None:
+            def op():
+                func(self.fetch())
+                self.cycles += c
+        else:
+            def op():
+                func(self.read(am(True)))
+                self.cycles += c
+        return op
+
+
+    def make_store(self, value, am, c):
+        def op():
+            self.write(am(False), value())
+            self.cycles += c
+        return op
+
+
+    def make_rmw(self, func, am, c):
+        def op():
+            addr = am(False)
+            self.write(addr, func(self.read(addr)))
+            self.cycles += c
+        return op
+
+
+    def make_acc(self, func):
+        def op():
+            self.a = func(self.a)
+            self.cycles += 2
+        return op
+
+
+    def make_branch(self, mask, value):
+        def op():
+            rel = self.fetch()
+            if self.p & mask == value:
+                target = (self.pc + rel - (0x100 if rel & 0x80 else 0)) & 0xFFFF
+                self.cycles += 4 if (target ^ self.pc) & 0xFF00 else 3
+                self.pc = target
+            else:
+                self.cycles += 2
+        return op
+
+
+    # operations
+
+    def op_lda(self, v):
+        self.a = v
+        self.set_nz(v)
+
+
+    def op_ldx(self, v):
+        self.x = v
+        self.set_nz(v)
+
+
+    def op_ldy(self, v):
+        self.y = v
+        self.set_nz(v)
+
+
+    def op_and(self, v):
+        self.a &= v
+        self.set_nz(self.a)
+
+
+    def op_ora(self, v):
+        self.a |= v
+        self.set_nz(self.a)
+
+
+    def op_eor(self, v):
+        self.a ^= v
+        self.set_nz(self.a)
+
+
+    def compare(self, r, v):
+        d = (r - v) & 0x1FF
+        self.p = (self.p & 0x7C) | (d & 0x80) | (0 if d & 0xFF else FLAG_Z) | (0 if d & 0x100 else FLAG_C)
+
+
+    def op_cmp(self, v):
+        self.compare(self.a, v)
+
+
+    def op_cpx(self, v):
+        self.compare(self.x, v)
+
+
+    def op_cpy(self, v):
+        self.compare(self.y, v)
+
+
+    def op_bit(self, v):
+        self.p = (self.p & 0x3D) | (v & 0xC0) | (0 if v & self.a else FLAG_Z)
+
+
+    def op_adc(self, v):
+        c = self.p & FLAG_C
+        if self.p & FLAG_D:
+            lo = (self.a & 0x0F) + (v & 0x0F) + c
+            if lo > 9:
+                lo += 6
+            hi = (self.a >> 4) + (v >> 4) + (lo > 0x0F)
+            r = (self.a + v + c) & 0xFF
+            self.p = (self.p & 0x3C) | (0 if r else FLAG_Z) | ((hi << 4) & 0x80) \
+                | (FLAG_V if ~(self.a ^ v) & (self.a ^ (hi << 4)) & 0x80 else 0)
+            if hi > 9:
+                hi += 6
+            self.p |= FLAG_C if hi > 0x0F else 0
+            self.a = ((hi << 4) | (lo & 0x0F)) & 0xFF
+            return
+        r = self.a + v + c
+        self.p = (self.p & 0x3C) | (FLAG_C if r > 0xFF else 0) \
+            | (FLAG_V if ~(self.a ^ v) & (self.a ^ r) & 0x80 else 0)
+        self.a = r & 0xFF
+        self.set_nz(self.a)
+
+
+    def op_sbc(self, v):
+        c = self.p & FLAG_C
+        r = self.a - v - (1 - c)
+        if self.p & FLAG_D:
+            lo = (self.a & 0x0F) - (v & 0x0F) - (1 - c)
+            hi = (self.a >> 4) - (v >> 4) - (lo < 0)
+            if lo < 0:
+                lo -= 6
+            if hi < 0:
+                hi -= 6
+            self.p = (self.p & 0x3C) | (0 if r < 0 else FLAG_C) \
+                | (FLAG_V if (self.a ^ v) & (self.a ^ r) & 0x80 else 0)
+            self.set_nz(r & 0xFF)
+            self.a = ((hi << 4) | (lo & 0x0F)) & 0xFF
+            return
+        self.p = (self.p & 0x3C) | (0 if r < 0 else FLAG_C) \
+            | (FLAG_V if (self.a ^ v) & (self.a ^ r) & 0x80 else 0)
+        self.a = r & 0xFF
+        self.set_nz(self.a)
+
+
+    def op_asl(self, v):
+        self.p = (self.p & ~FLAG_C) | (v >> 7)
+        v = (v << 1) & 0xFF
+        self.set_nz(v)
+        return v
+
+
+    def op_lsr(self, v):
+        self.p = (self.p & ~FLAG_C) | (v & 1)
+        v >>= 1
+        self.set_nz(v)
+        return v
+
+
+    def op_rol(self, v):
+        c = self.p & FLAG_C
+        self.p = (self.p & ~FLAG_C) | (v >> 7)
+        v = ((v << 1) | c) & 0xFF
+        self.set_nz(v)
+        return v
+
+
+    def op_ror(self, v):
+        c = self.p & FLAG_C
+        self.p = (self.p & ~FLAG_C) | (v & 1)
+        v = (v >> 1) | (c << 7)
+        self.set_nz(v)
+        return v
+
+
+    def op_inc(self, v):
+        v = (v + 1) & 0xFF
+        self.set_nz(v)
+        return v
+
+
+    def op_dec(self, v):
+        v = (v - 1) & 0xFF
+        self.set_nz(v)
+        return v
+
+
+class Disk:
+    """Single density disk image"""
+
+    def __init__(self, sectors):
+        self.sectors = sectors      # list of 128 byte sectors, sector 1 at index 0
+
+
+    @classmethod
+    def load_atr(cls, filename):
+        with open(filename, 'rb') as f:
+            atr = f.read()
+        magic, paras, secsize = struct.unpack('<HHH', atr[:6])
+        if magic != 0x0296 or secsize != 128:
+            raise ValueError(f'"{filename}" is not single density ATR image')
+        data = atr[16:]
+        return cls([data[i:i+128] for i in range(0, len(data), 128)])
+
+
+    @classmethod
+    def build(cls, boot, files, sectors=720):
+        """Build DOS 2 disk, boot sectors followed by files, first file starts at sector 4
+
+        Start sector and size of second file are stored into the first one,
+        as update-atr.py does for CLOADER.ZX0 and CONFIG.COM.
+        """
+        disk = [bytearray(128) for _ in range(sectors)]
+        for i in range(0, len(boot), 128):
+            disk[i // 128][:len(boot[i:i+128])] = boot[i:i+128]
+        sec = 4
+        entries = []
+        for fileno, data in enumerate(files):
+            start = sec
+            count = 0
+            for of in range(0, max(len(data), 1), 125):
+                chunk = data[of:of+125]
+                nxt = sec + 1
+                if 360 <= nxt <= 368:
+                    nxt = 369
+                if of + 125 >= len(data):
+                    nxt = 0
+                s = disk[sec - 1]
+                s[:len(chunk)] = chunk
+                s[125] = (fileno << 2) | (nxt >> 8)
+                s[126] = nxt & 0xFF
+                s[127] = len(chunk)
+                count += 1
+                sec = nxt
+            entries.append((start, count))
+            sec = 4 + sum(c for s, c in entries)
+        for i, (start, count) in enumerate(entries):
+            disk[360][16*i:16*i+5] = struct.pack('<BHH', 0x42, count, start)
+            disk[360][16*i+5:16*i+16] = f"FILE{i:<4}COM".encode("ASCII")
+        if len(entries) > 1:
+            # CONFIG size, start sector and progress bar speed factor (see update-atr.py)
+            s = disk[entries[0][0] - 1]
+            start, count = entries[1]
+            s[6:10] = count if count < 256 else 0, start & 0xFF, start >> 8, min(255, 49 * 256 // max(1, count - 2))
+        return cls([bytes(s) for s in disk])
+
+
+    def save_atr(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(struct.pack('<HHH', 0x0296, len(self.sectors) * 128 // 16, 128) + bytes(10))
+            for s in self.sectors:
+                f.write(s)
+
+
+class SioDrive:
+    """SIO disk drive D1: with timing of command processing"""
+
+    def __init__(self, disk, hsindex=6, ack_delay=850, latency=250, gap=0, burst=True):
+        self.disk = disk
+        self.hsindex = hsindex      # POKEY divisor for high speed, None = no high speed
+        self.burst = burst          # burst command supported, NAK otherwise
+        self.ack_delay = us(ack_delay)
+        self.latency = us(latency)  # ACK to COMPLETE, sector read time
+        self.gap = us(gap)          # COMPLETE to data frame
+        self.log = []               # processed commands
+
+
+    def response(self, frame, divisor, now):
+        """Return list of response bytes and delays (cycles before byte), None if not for us"""
+        if len(frame) != 5 or frame[0] != 0x31 or sio_checksum(frame[:4]) != frame[4]:
+            return None
+        if divisor != STD_DIVISOR and divisor != self.hsindex:
+            return None
+        cmd, aux = frame[1], frame[2] | frame[3] << 8
+        self.log.append({'cmd': cmd, 'aux': aux, 'divisor': divisor, 'time': now})
+        data = None
+        if cmd == 0x52:
+            if 1 <= aux <= len(self.disk.sectors):
+                data = self.disk.sectors[aux - 1]
+        elif cmd == 0x53:
+            data = bytes((0x10, 0xFF, 0xE0, 0x00))
+        elif cmd == 0x3F and self.hsindex is not None:
+            data = bytes((self.hsindex,))
+        elif cmd == BURST_CMD and self.burst:
+            # AUX bits 0-11 start sector, bits 12-15 number of sectors - 1
+            first, n = aux & 0xFFF, (aux >> 12) + 1
+            if 1 <= first and first + n - 1 <= len(self.disk.sectors):
+                data = b''.join(self.disk.sectors[first-1:first-1+n])
+        else:
+            return [(self.ack_delay, ord('N'))]
+        if data is None:
+            return [(self.ack_delay, ord('A')), (self.latency, ord('E'))]
+        out = [(self.ack_delay, ord('A')), (self.latency, ord('C'))]
+        out.append((self.gap, data[0]))
+        out.extend((0, b) for b in data[1:])
+        out.append((0, sio_checksum(data)))
+        return out
+
+
+class Pokey:
+    """POKEY serial port, registers as seen by HISIO"""
+
+    def __init__(self, machine):
+        self.machine = machine
+        self.audf3 = 0
+        self.audf4 = 0
+        self.audctl = 0
+        self.skctl = 0
+        self.irqen = 0
+        self.irqst = 0xFF       # latched interrupts, active low
+        self.serin = 0
+        self.overrun = False
+        self.framing = False
+        self.out_buf = None     # byte written to SEROUT, waiting for shift register
+        self.out_done = 0       # cycle when shift register is empty
+        self.command = False    # command line asserted
+        self.frame = []         # bytes received by device while command line is asserted
+        self.frame_divisor = STD_DIVISOR
+        self.incoming = deque() # (cycle, byte, divisor) sent by device
+        self.bus_cycles = 0     # cycles the serial line carried data
+        self.overruns = 0
+        self.framing_errors = 0
+
+
+    def divisor(self):
+        return self.audf3 | self.audf4 << 8
+
+
+    def update(self, now):
+        # output shift register
+        while self.out_buf is not None and self.out_done <= now:
+            self.shift_out(self.out_done, self.out_buf)
+            self.out_buf = None
+        # input
+        while self.incoming and self.incoming[0][0] <= now:
+            t, b, divisor = self.incoming.popleft()
+            if divisor != self.divisor():
+                self.framing = True
+                self.framing_errors += 1
+                b ^= 0x55
+            if self.irqst & 0x20 == 0:
+                # previous byte not acknowledged yet
+                self.overrun = True
+                self.overruns += 1
+            self.serin = b
+            if self.irqen & 0x20:
+                self.irqst &= ~0x20
+
+
+    def irq_pending(self, now):
+        """Return latched serial IRQs (data received, ready to send) which are enabled"""
+        if (self.incoming and self.incoming[0][0] <= now) or (self.out_buf is not None and self.out_done <= now):
+            self.update(now)
+        return ~self.irqst & self.irqen & 0x30
+
+
+    def shift_out(self, start, b):
+        c = byte_cycles(self.divisor())
+        self.out_done = start + c
+        self.bus_cycles += c
+        if self.irqen & 0x10:
+            self.irqst &= ~0x10
+        if self.command:
+            self.frame.append(b)
+            self.frame_divisor = self.divisor()
+
+
+    def read(self, reg, now):
+        self.update(now)
+        if reg == 0x0D:
+            return self.serin
+        if reg == 0x0E:
+            v = self.irqst
+            if self.out_buf is None and self.out_done <= now:
+                v &= ~0x08      # transmission done, not latched
+            return v
+        if reg == 0x0F:
+            v = 0xFF
+            if self.framing:
+                v &= ~0x80
+            if self.overrun:
+                v &= ~0x20
+            return v
+        return 0xFF
+
+
+    def write(self, reg, v, now):
+        self.update(now)
+        if reg == 0x04:
+            self.audf3 = v
+        elif reg == 0x06:
+            self.audf4 = v
+        elif reg == 0x08:
+            self.audctl = v
+        elif reg == 0x0A:
+            self.overrun = False
+            self.framing = False
+        elif reg == 0x0D:
+            if self.out_done <= now and self.out_buf is None:
+                self.shift_out(now, v)
+            else:
+                self.out_buf = v
+        elif reg == 0x0E:
+            self.irqen = v
+            self.irqst |= ~v & 0xFF
+        elif reg == 0x0F:
+            self.skctl = v
+
+
+    def command_line(self, asserted, now):
+        self.update(now)
+        if self.command and not asserted:
+            # command frame sent, let the device process it
+            start = max(now, self.out_done)
+            resp = self.machine.drive.response(self.frame, self.frame_divisor, start)
+            if resp is not None:
+                t = start
+                for delay, b in resp:
+                    t += delay + byte_cycles(self.frame_divisor)
+                    self.incoming.append((t, b, self.frame_divisor))
+                    self.bus_cycles += byte_cycles(self.frame_divisor)
+        if asserted and not self.command:
+            self.frame = []
+            self.incoming.clear()
+        self.command = asserted
+
+
+class Atari:
+    """Atari 800XL with emulated OS, POKEY serial port and SIO drive"""
+
+    def __init__(self, drive, pal=False, select=False):
+        self.mem = bytearray(0x10000)
+        self.cpu = CPU6502(self.read, self.write)
+        self.pokey = Pokey(self)
+        self.drive = drive
+        self.pal = pal
+        self.select = select
+        self.frame_cycles = FRAME_PAL if pal else FRAME_NTSC
+        self.next_vbi = self.frame_cycles - (262 - VBI_LINE) * SCANLINE
+        self.nmien = 0x40
+        self.traps = {
+            SIOV: self.os_siov,
+            SETVBV: self.os_setvbv,
+            SYSVBV: self.os_sysvbv,
+            XITVBV: self.os_xitvbv,
+            OSNMI: self.os_nmi,
+            OSIRQ: self.os_irq,
+            OSIRQDEF: self.os_irqdef,
+        }
+        self.runs = []          # (cycle, address) of program starts via JMP (RUNAD)
+        self.first_output = None  # cycle of first VBI with display DMA enabled
+        self.watch = {}         # address -> callback(cycle, value) on write
+        self.os_sio_cycles = 0
+        self.os_sio_count = 0
+        # OS variables
+        m = self.mem
+        m[0xFFFA:0xFFFC] = struct.pack('<H', OSNMI)
+        m[0xFFFE:0x10000] = struct.pack('<H', OSIRQ)
+        m[VIMIRQ:VIMIRQ+2] = struct.pack('<H', OSIRQDEF)
+        m[VVBLKI:VVBLKI+4] = struct.pack('<HH', SYSVBV, XITVBV)
+        m[0x10] = 0xC0          # POKMSK
+        m[0x41] = 3             # SOUNDR
+        m[0x2E0:0x2E4] = bytes(4)
+
+
+    def frame(self):
+        return self.cpu.cycles / self.frame_cycles
+
+
+    def read(self, addr):
+        if 0xD000 <= addr < 0xD800:
+            page = addr & 0xFF00
+            now = self.cpu.cycles
+            if page == 0xD200:
+                return self.pokey.read(addr & 0x0F, now)
+            if addr == 0xD01F:
+                return 5 if self.select else 7      # CONSOL, Select
+            if addr == 0xD014:
+                return 1 if self.pal else 15        # PAL
+            if addr == 0xD40B:
+                line = (now - self.next_vbi + VBI_LINE * SCANLINE) % self.frame_cycles // SCANLINE
+                return line >> 1                    # VCOUNT
+            return 0xFF
+        return self.mem[addr]
+
+
+    def write(self, addr, v):
+        if 0xD000 <= addr < 0xD800:
+            page = addr & 0xFF00
+            now = self.cpu.cycles
+            if page == 0xD200:
+                self.pokey.write(addr & 0x0F, v, now)
+            elif addr == 0xD303:
+                self.pokey.command_line(v & 0x08 == 0, now)
+            elif addr == 0xD40A:
+                # WSYNC, wait for the end of scan line
+                line = (now - self.next_vbi) // SCANLINE
+                self.cpu.cycles = self.next_vbi + (line + 1) * SCANLINE
+            elif addr == 0xD40E:
+                self.nmien = v
+            return
+        if addr >= 0xC000:
+            return
+        self.mem[addr] = v
+        if addr in self.watch:
+            self.watch[addr](self.cpu.cycles, v)
+
+
+    def load(self, addr, data):
+        self.mem[addr:addr+len(data)] = data
+
+
+    # emulated OS
+
+    def os_nmi(self):
+        # VBI: save registers, continue with immediate VBI
+        cpu = self.cpu
+        cpu.push(cpu.a)
+        cpu.push(cpu.x)
+        cpu.push(cpu.y)
+        cpu.pc = self.mem[VVBLKI] | self.mem[VVBLKI+1] << 8
+        cpu.cycles += 20
+
+
+    def os_irq(self):
+        cpu = self.cpu
+        cpu.pc = self.mem[VIMIRQ] | self.mem[VIMIRQ+1] << 8
+        cpu.cycles += 8
+
+
+    def os_irqdef(self):
+        # acknowledge serial IRQs, no OS serial I/O in progress
+        cpu = self.cpu
+        self.pokey.irqst |= self.pokey.irq_pending(cpu.cycles)
+        cpu.p = cpu.pull() & ~FLAG_B | 0x20
+        cpu.pc = cpu.pull_word()
+        cpu.cycles += 30
+
+
+    def os_sysvbv(self):
+        self.tick_rtclok(1)
+        cpu = self.cpu
+        cpu.cycles += 40
+        if self.mem[CRITIC]:
+            cpu.pc = XITVBV
+        else:
+            if self.first_output is None and self.mem[SDMCTL]:
+                self.first_output = cpu.cycles
+            cpu.pc = self.mem[VVBLKD] | self.mem[VVBLKD+1] << 8
+
+
+    def os_xitvbv(self):
+        cpu = self.cpu
+        cpu.y = cpu.pull()
+        cpu.x = cpu.pull()
+        cpu.a = cpu.pull()
+        cpu.p = cpu.pull() & ~FLAG_B | 0x20
+        cpu.pc = cpu.pull_word()
+        cpu.cycles += 20
+
+
+    def os_setvbv(self):
+        cpu = self.cpu
+        if cpu.a == 1:
+            self.mem[0x218] = cpu.y
+            self.mem[0x219] = cpu.x
+        cpu.rts()
+        cpu.cycles += 30
+
+
+    def tick_rtclok(self, frames):
+        t = (self.mem[RTCLOK] << 16 | self.mem[RTCLOK+1] << 8 | self.mem[RTCLOK+2]) + frames
+        self.mem[RTCLOK:RTCLOK+3] = bytes(((t >> 16) & 0xFF, (t >> 8) & 0xFF, t & 0xFF))
+
+
+    def os_siov(self):
+        """Standard speed SIO on DCB level"""
+        cpu = self.cpu
+        m = self.mem
+        ddevic, dunit, dcomnd, dstats = m[DCB:DCB+4]
+        dbuf, dtimlo, dbyt, daux = struct.unpack('<HBxHH', m[DCB+4:DCB+12])
+        frame = bytes((ddevic + dunit - 1, dcomnd, daux & 0xFF, daux >> 8))
+        frame += bytes((sio_checksum(frame),))
+        c = byte_cycles(STD_DIVISOR)
+        start = cpu.cycles
+        t = 5 * c
+        status = 0x8A           # timeout
+        resp = self.drive.response(frame, STD_DIVISOR, start)
+        if resp is not None:
+            data = []
+            for delay, b in resp:
+                t += delay + c
+                data.append(b)
+            if data[0] != ord('A'):
+                status = 0x8B
+            elif data[1] != ord('C'):
+                status = 0x90
+            else:
+                status = 1
+                if dstats & 0x40:
+                    m[dbuf:dbuf+dbyt] = bytes(data[2:2+dbyt])
+            self.pokey.bus_cycles += (5 + len(data)) * c
+        self.os_sio_cycles += t
+        self.os_sio_count += 1
+        self.advance(t + 800)
+        m[DCB+3] = status
+        cpu.y = status
+        cpu.set_nz(status)
+        cpu.rts()
+
+
+    def advance(self, cycles):
+        """Let time pass with OS VBI running"""
+        cpu = self.cpu
+        end = cpu.cycles + cycles
+        while self.next_vbi <= end:
+            if self.nmien & 0x40:
+                self.tick_rtclok(1)
+            self.next_vbi += self.frame_cycles
+        cpu.cycles = end
+
+
+    def boot(self):
+        """OS disk boot: load boot sectors, call boot loader"""
+        m = self.mem
+        m[DCB:DCB+12] = struct.pack('<BBBBHBxHH', 0x31, 1, 0x52, 0x40, 0x400, 0x0F, 128, 1)
+        sector = bytearray()
+        count = 1
+        i = 0
+        while i < count:
+            m[DCB+2] = 0x52
+            m[DCB+3] = 0x40
+            m[DCB+4:DCB+6] = struct.pack('<H', 0x400)
+            m[DCB+10:DCB+12] = struct.pack('<H', i + 1)
+            cpu = self.cpu
+            cpu.push_word(0)    # return address for the emulated SIOV
+            self.os_siov()
+            if m[DCB+3] != 1:
+                raise RuntimeError("boot sector read failed")
+            sector += m[0x400:0x480]
+            if i == 0:
+                count = sector[1]
+            i += 1
+        load, init = struct.unpack('<HH', sector[2:6])
+        self.load(load, sector)
+        m[DOSINI:DOSINI+2] = struct.pack('<H', init)
+        self.cpu.sp = 0xFF
+        self.cpu.push_word(OSNMI - 1)
+        self.cpu.pc = load + 6
+
+
+    def run(self, runs=2, max_frames=3000):
+        """Run until program was started runs times via JMP (RUNAD)"""
+        cpu = self.cpu
+        ops = cpu.ops
+        traps = self.traps
+        mem = self.mem
+        pokey = self.pokey
+        limit = max_frames * self.frame_cycles
+        while cpu.cycles < limit:
+            if cpu.cycles >= self.next_vbi:
+                self.next_vbi += self.frame_cycles
+                if self.nmien & 0x40:
+                    cpu.nmi()
+            elif not cpu.p & FLAG_I and pokey.irq_pending(cpu.cycles):
+                cpu.irq()
+            pc = cpu.pc
+            trap = traps.get(pc)
+            if trap is not None:
+                trap()
+                continue
+            opcode = mem[pc]
+            if opcode == 0x6C and mem[pc+1] == 0xE0 and mem[pc+2] == 0x02:
+                # JMP (RUNAD)
+                self.runs.append((cpu.cycles, mem[RUNAD] | mem[RUNAD+1] << 8))
+                if len(self.runs) >= runs:
+                    cpu.pc = self.runs[-1][1]
+                    return True
+            cpu.pc = (pc + 1) & 0xFFFF
+            op = ops[opcode]
+            if op is None:
+                raise RuntimeError(f"illegal opcode {opcode:02X} at {pc:04X}")
+            op()
+        return False
+
+
+def report(atari, done):
+    cpu = atari.cpu
+    drive = atari.drive
+    pokey = atari.pokey
+    reads = [c for c in drive.log if c['cmd'] in (0x52, BURST_CMD)]
+    bursts = [c for c in reads if c['cmd'] == BURST_CMD]
+    hs = [c for c in reads if c['divisor'] != STD_DIVISOR]
+    sectors = {}
+    for c in reads:
+        sectors[(c['cmd'], c['aux'])] = sectors.get((c['cmd'], c['aux']), 0) + 1
+    retries = sum(n - 1 for n in sectors.values())
+    r = {
+        'finished': done,
+        'cycles': cpu.cycles,
+        'frames': round(atari.frame(), 1),
+        'seconds': round(cpu.cycles / CPU_CLOCK, 3),
+        'runs': [{'address': a, 'frame': round(c / atari.frame_cycles, 1)} for c, a in atari.runs],
+        'first_output': None if atari.first_output is None else round(atari.first_output / atari.frame_cycles, 1),
+        'sector_reads': len(reads),
+        'burst_reads': len(bursts),
+        'burst_sectors': sum((c['aux'] >> 12) + 1 for c in bursts),
+        'high_speed_reads': len(hs),
+        'retries': retries,
+        'overruns': pokey.overruns,
+        'framing_errors': pokey.framing_errors,
+        'serial_busy': round(pokey.bus_cycles / cpu.cycles, 3) if cpu.cycles else 0,
+    }
+    return r
+
+
+def print_report(r):
+    state = "Loaded" if r['finished'] else "NOT finished"
+    print(f"{state} in {r['frames']} frames ({r['seconds']} s, {r['cycles']} cycles)")
+    if r['first_output'] is not None:
+        print(f"  first visible output at frame {r['first_output']}")
+    else:
+        print("  no visible output")
+    for run in r['runs']:
+        print(f"  RUN {run['address']:04X} at frame {run['frame']}")
+    print(f"  sector reads: {r['sector_reads']} ({r['high_speed_reads']} high speed), retries: {r['retries']}")
+    if r['burst_reads']:
+        print(f"  burst reads: {r['burst_reads']}, {r['burst_sectors']} sectors")
+    print(f"  overruns: {r['overruns']}, framing errors: {r['framing_errors']}")
+    print(f"  serial line busy: {100*r['serial_busy']:.1f}%")
+
+
+def main():
+    o_atr = None
+    o_boot = None
+    o_files = []
+    o_save = None
+    o_mem = None
+    o_json = None
+    o_runs = 2
+    o_frames = 3000
+    o_pal = False
+    o_select = False
+    drive_opts = {}
+
+    args = sys.argv[1:]
+    while args:
+        arg = args.pop(0)
+        try:
+            if arg == '--boot':
+                o_boot = args.pop(0)
+            elif arg == '--file':
+                o_files.append(args.pop(0))
+            elif arg == '--save-atr':
+                o_save = args.pop(0)
+            elif arg == '--save-mem':
+                o_mem = args.pop(0)
+            elif arg == '--json':
+                o_json = args.pop(0)
+            elif arg == '--runs':
+                o_runs = int(args.pop(0))
+            elif arg == '--frames':
+                o_frames = int(args.pop(0))
+            elif arg == '--hsindex':
+                v = args.pop(0)
+                drive_opts['hsindex'] = None if v == 'none' else int(v, 0)
+            elif arg in ('--ack', '--latency', '--gap'):
+                drive_opts[{'--ack': 'ack_delay', '--latency': 'latency', '--gap': 'gap'}[arg]] = int(args.pop(0))
+            elif arg == '--pal':
+                o_pal = True
+            elif arg == '--no-burst':
+                drive_opts['burst'] = False
+            elif arg == '--select':
+                o_select = True
+            elif arg == '-h':
+                print_help()
+                sys.exit(0)
+            elif arg[0] == '-':
+                print(f'Unknown option: "{arg}"')
+                sys.exit(1)
+            elif o_atr is None:
+                o_atr = arg
+            else:
+                print(f'Extra parameter: "{arg}"')
+                sys.exit(1)
+        except (IndexError, ValueError):
+            print(f'Option {arg} requires a value')
+            sys.exit(1)
+
+    if o_boot is not None:
+        with open(o_boot, 'rb') as f:
+            boot = f.read()
+        files = []
+        for fn in o_files:
+            with open(fn, 'rb') as f:
+                files.append(f.read())
+        disk = Disk.build(boot, files)
+        if o_save is not None:
+            disk.save_atr(o_save)
+    elif o_atr is not None:
+        disk = Disk.load_atr(o_atr)
+    else:
+        print_help()
+        sys.exit(1)
+
+    atari = Atari(SioDrive(disk, **drive_opts), pal=o_pal, select=o_select)
+    atari.boot()
+    done = atari.run(o_runs, o_frames)
+    r = report(atari, done)
+    print_report(r)
+    if o_mem is not None:
+        with open(o_mem, 'wb') as f:
+            f.write(atari.mem)
+    if o_json is not None:
+        with open(o_json, 'w') as f:
+            json.dump(r, f, indent=2)
+            f.write('\n')
+    sys.exit(0 if done else 1)
+
+
+def print_help():
+    print("""Emulated SIO harness for boot and config loader
+Usage: a8emu.py [options] atr_file
+       a8emu.py [options] --boot zx0boot.bin --file cloader.zx0 --file config.com
+  --boot FILE     Boot sectors, disk is built from boot sectors and files
+  --file FILE     File on built disk, first file starts at sector 4,
+                  start sector of second file is stored into the first one
+  --save-atr FILE Save built disk as ATR image
+  --save-mem FILE Save 64 KB of memory when finished (e.g. for a8timing.py)
+  --hsindex N     High speed index (POKEY divisor) of drive, none = no high speed (default 6)
+  --ack US        Delay of ACK after command frame, in microseconds (default 850)
+  --latency US    Delay of COMPLETE after ACK (default 250)
+  --gap US        Delay of data frame after COMPLETE (default 0)
+  --no-burst      Drive does not support burst reads (NAK)
+  --pal           PAL machine (frame of 312 scan lines)
+  --select        Hold Select during boot (config loader uses standard SIO)
+  --runs N        Stop at N-th start of program via JMP ($02E0) (default 2)
+  --frames N      Give up after N frames (default 3000)
+  --json FILE     Write results to FILE
+  -h              Print this help
+""")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#  a8mem.py - Memory map of Atari 8-bit address space
+#    occupancy of 64 KB address space and allocation of free gaps,
+#    used to place unpacker, packed data and relocation tables
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+
+import re
+
+
+# lowest free address with DOS loaded (DOS 2.x / MyDOS MEMLO is below $2000)
+MEMLO = 0x2000
+# highest free address, below GR.0 screen and display list with RAMTOP $C0
+MEMTOP = 0xBC1F
+
+OS = "OS"
+
+
+class LayoutError(Exception):
+    pass
+
+
+def parse_addr(text):
+    """Parse address given as $XXXX, 0xXXXX or decimal number"""
+    if text.startswith('$'):
+        return int(text[1:], 16)
+    return int(text, 0)
+
+
+class MemoryMap:
+    """Occupancy of 64 KB address space
+
+    Every address is free or owned by a named owner. Addresses below memlo
+    and above memtop are owned by OS.
+    """
+
+    def __init__(self, memlo=MEMLO, memtop=MEMTOP):
+        self.memlo = memlo
+        self.memtop = memtop
+        self.used = bytearray(0x10000)  # occupancy, 1 = used
+        self.ranges = []                # (start, end, owner), later ones take precedence
+        if memlo > 0:
+            self.mark(0, memlo - 1, OS)
+        if memtop < 0xFFFF:
+            self.mark(memtop + 1, 0xFFFF, OS)
+
+
+    def mark(self, start, end, owner):
+        """Mark range as owned by owner, no checks"""
+        if end < start:
+            return
+        self.used[start:end+1] = b'\x01' * (1 + end - start)
+        self.ranges.append((start, end, owner))
+
+
+    def owners(self, start, end):
+        """Return owners of addresses in range, as list of (start, end, owner)"""
+        # walk ranges from the latest one, parts of range not claimed yet belong to it
+        found = []
+        todo = [(start, end)]
+        for rs, re_, owner in reversed(self.ranges):
+            rest = []
+            for s, e in todo:
+                if re_ < s or rs > e:
+                    rest.append((s, e))
+                    continue
+                found.append((max(s, rs), min(e, re_), owner))
+                if s < rs:
+                    rest.append((s, rs - 1))
+                if e > re_:
+                    rest.append((re_ + 1, e))
+            todo = rest
+            if not todo:
+                break
+        return found
+
+
+    def conflicts(self, start, end, allow=()):
+        """Return list of owners of range, except allowed ones"""
+        found = []
+        if end < start:
+            return found
+        if self.used.find(b'\x01', start, end+1) < 0:
+            return found
+        for s, e, owner in self.owners(start, end):
+            if owner not in allow and owner not in found:
+                found.append(owner)
+        return found
+
+
+    def gaps(self):
+        """Return list of free ranges (start, end)"""
+        return [(m.start(), m.end() - 1) for m in re.finditer(b'\x00+', self.used)]
+
+
+    def alloc(self, size, owner):
+        """Place size bytes into smallest free gap, return start address"""
+        best = None
+        for start, end in self.gaps():
+            n = 1 + end - start
+            if n >= size and (best is None or n < 1 + best[1] - best[0]):
+                best = (start, end)
+        if best is None:
+            raise LayoutError(f"no free memory for {owner} ({size} bytes)"
+                f" between {self.memlo:04X} and {self.memtop:04X}")
+        self.mark(best[0], best[0] + size - 1, owner)
+        return best[0]
+
+
+    def print_map(self):
+        ranges = self.owners(0, 0xFFFF) + [(s, e, "free") for s, e in self.gaps()]
+        for start, end, owner in sorted(ranges):
+            print(f"{start:04X}-{end:04X} {owner}")
@@ -24,11 +24,41 @@ import sys
 import os
 import struct
 import subprocess
+import tempfile
 import re
+import time
+import json
+import csv
+import functools
+import importlib.util
+
+import a8mem
+
+
+def load_tool(name):
+    """Import tool script from this directory, name may contain '-'"""
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(os.path.dirname(__file__), name + ".py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# ATR patching for --atr
+update_atr = load_tool("update-atr")
+
 
 SEGMENT_SIGNATURE = 'SIGNATURE' # 0xffff
 SEGMENT_DATA = 'DATA'           # standard data block with: start,end,data[1+end-start]
-SEGMENT_PACKED = 'PACKED'       # compressed data: start,0x0000,packer method (1 byte),data[unknown length when saved]
+SEGMENT_PACKED = 'PACKED'       # compressed data: start,0x0000,[v2 header],packer method (1 byte),data
+
+# Packed segment formats
+#   v1: start,0x0000,packer method,data[unknown length, till the end of file]
+#   v2: start,0x0000,0x82,length[3],unpacked end[3],packer method,data[length]
+# In v2 header the length of packed data and the end address of unpacked data are
+# stored in 3 bytes, 7 bits per byte (low bits first) with bit 7 set in each byte.
+# No byte of v2 header is a valid packer method, a loader can skip the header
+# by reading bytes until it gets the method it expects.
+PACKED_V2 = 0x82     # format v2 marker
 
 PACK_LZ4 = 0x00
 PACK_APL = 0x01
@@ -52,7 +82,208 @@ packers = {
 }
 
 
+def pack_word7(w):
+    """Encode 16-bit value as 3 bytes of 7 bits, bit 7 set"""
+    return bytes((0x80 | w & 0x7F, 0x80 | (w >> 7) & 0x7F, 0x80 | w >> 14))
+
+
+def unpack_word7(b):
+    return (b[0] & 0x7F) | (b[1] & 0x7F) << 7 | (b[2] & 0x7F) << 14
+
+
+# per pass metrics, collected when enabled with --metrics or --profile
+metrics = None
+
+# payload bytes copied when segment fixups were applied
+copied_bytes = 0
+
+# packed segments and unpacker kept between rebuilds, enabled with --watch
+cache = None
+
+DOS_SECTOR_DATA = 125   # data bytes in Atari DOS 2 single density sector
+
+# unpacker parameters at the start of unpacker: DECOMP_TO, LDA COMP_DATA
+UNPACKER_PARAMS = 5
+# hybrid file bytes added for each packed segment after the first one:
+# hint segment, segments with unpacker parameters and INIT address
+HYBRID_SEGMENT_OVERHEAD = (4 + 3) + (4 + UNPACKER_PARAMS) + (4 + 2)
+
+# config loader in ATR image, updated with --atr when packed file changes size
+LOADER_FILE = "cloader.zx0"
+# seconds between checks of watched files
+WATCH_INTERVAL = 0.05
+
+
+class Metrics:
+    """Wall time, sizes and segment counts of passes, compressor timing of segments"""
+
+    def __init__(self, profile_dir=None):
+        self.passes = []
+        self.segments = []
+        self.cache_hits = 0     # segments packed with help of cache, not by running the packer
+        self.profile_dir = profile_dir
+        self.depth = 0
+
+
+    def measure(self, name, method, obj, *args, **kwargs):
+        bytes_in = obj.size()
+        segments_in = len(obj.segments)
+        if name == 'load':
+            bytes_in = os.path.getsize(args[0])
+        profiler = None
+        if self.profile_dir is not None and self.depth == 0:
+            import cProfile
+            profiler = cProfile.Profile()
+        record = {'pass': name, 'depth': self.depth}
+        # keep order of passes as they were started
+        self.passes.append(record)
+        index = len(self.passes)
+        cache_hits = self.cache_hits
+        copied = copied_bytes
+        self.depth += 1
+        t = time.perf_counter()
+        try:
+            if profiler is not None:
+                result = profiler.runcall(method, obj, *args, **kwargs)
+            else:
+                result = method(obj, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - t
+            self.depth -= 1
+        out = result if isinstance(result, AtariDosObject) else obj
+        bytes_out = out.size()
+        record.update({
+            'time': elapsed,
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+            'segments_in': segments_in,
+            'segments_out': len(out.segments),
+            'packed_segments': sum(1 for s in out.segments if s.type == SEGMENT_PACKED),
+            'sectors': (bytes_out + DOS_SECTOR_DATA - 1) // DOS_SECTOR_DATA,
+            'cache_hits': self.cache_hits - cache_hits,
+            'bytes_copied': copied_bytes - copied,
+        })
+        if profiler is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(self.profile_dir, f"{index:02d}-{name}.prof"))
+        return result
+
+
+    def add_segment(self, segment, packed, elapsed):
+        self.segments.append({
+            'start': segment.start,
+            'end': segment.end,
+            'bytes_in': segment.len(),
+            'bytes_out': packed.datalen() if packed is not None else None,
+            'delta': packed.decomp_offset - segment.len() + packed.datalen() if packed is not None else None,
+            'time': elapsed,
+        })
+
+
+    def save(self, filename):
+        if filename.lower().endswith('.csv'):
+            fields = ['record', 'pass', 'depth', 'time', 'bytes_in', 'bytes_out', 'segments_in', 'segments_out',
+                'packed_segments', 'sectors', 'cache_hits', 'bytes_copied', 'start', 'end', 'delta']
+            with open(filename, 'w', newline='') as fout:
+                w = csv.DictWriter(fout, fieldnames=fields, restval='')
+                w.writeheader()
+                for p in self.passes:
+                    w.writerow(dict(p, record='pass'))
+                for s in self.segments:
+                    w.writerow(dict(s, record='segment'))
+        else:
+            with open(filename, 'w') as fout:
+                json.dump({
+                    'passes': self.passes,
+                    'segments': self.segments,
+                    'cache_hits': self.cache_hits,
+                    'total_time': sum(p['time'] for p in self.passes if p['depth'] == 0),
+                }, fout, indent=2)
+                fout.write('\n')
+
+
+class PackCache:
+    """Packed segments and relocated unpacker kept in memory between rebuilds
+
+    Packed data depends only on payload, segments with the same bytes are not
+    packed again. Entries not used by the last rebuild are dropped.
+    """
+
+    def __init__(self):
+        self.segments = {}      # (packer, payload) -> (packed data, delta)
+        self.used = set()
+        self.hits = 0
+        self.misses = 0
+        self.unpacker_file = None   # (file name, mtime) of loaded unpacker
+        self.unpacker_obj = None
+        self.relocated = {}     # address -> relocated unpacker
+
+
+    def get(self, key):
+        found = self.segments.get(key)
+        if found is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.used.add(key)
+        return found
+
+
+    def put(self, key, packed):
+        self.segments[key] = packed
+        self.used.add(key)
+
+
+    def prune(self):
+        """Drop segments not used since last prune"""
+        self.segments = {k: v for k, v in self.segments.items() if k in self.used}
+        self.used = set()
+
+
+    def unpacker(self, filename):
+        """Return loaded unpacker, load it again only when the file has changed"""
+        key = (filename, os.stat(filename).st_mtime_ns)
+        if self.unpacker_file != key:
+            self.unpacker_obj = AtariDosObject().load(filename)
+            self.unpacker_file = key
+            self.relocated = {}
+        return self.unpacker_obj
+
+
+    def relocated_unpacker(self, unpacker, addr):
+        obj = self.relocated.get(addr)
+        if obj is None:
+            obj = self.relocated[addr] = unpacker.relocate(addr)
+        # caller replaces segments of returned object
+        copy = AtariDosObject()
+        copy.segments = list(obj.segments)
+        return copy
+
+
+def measured(name):
+    """Record metrics of AtariDosObject pass, if metrics are enabled"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if metrics is None:
+                return method(self, *args, **kwargs)
+            return metrics.measure(name, method, self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class Segment:
+    """Segment of Atari DOS file
+
+    Payload is kept in buffer shared with the segment it was derived from
+    (e.g. memoryview of loaded file or payload of the segment before relocation).
+    Changes are recorded as fixups (offset -> byte) on top of the shared buffer,
+    these are applied when the segment is written. A private copy of the payload
+    is made only when the whole payload is requested via data attribute.
+    """
+
+    __slots__ = ('type', 'start', 'end', 'packer', 'decomp_offset', 'version', 'unpacked_end', 'source',
+        '_buf', '_fixups')
 
     def __init__(self, type, start=0, end=0):
         self.type = type
@@ -60,22 +291,53 @@ class Segment:
         self.end = end
         self.packer = -1
         self.decomp_offset = 0
-        self.data = None
+        self.version = 2            # format of packed segment
+        self.unpacked_end = None    # end address of unpacked data, if known
+        self._buf = None
+        self._fixups = None
         self.source = None # original/source segment for which pack() was called
 
 
+    @property
+    def data(self):
+        if self._fixups:
+            # first access to whole modified payload, make private copy
+            global copied_bytes
+            buf = bytearray(self._buf)
+            copied_bytes += len(buf)
+            for of, b in self._fixups.items():
+                buf[of] = b
+            self._buf = buf
+            self._fixups = None
+        return self._buf
+
+
+    @data.setter
+    def data(self, data):
+        self._buf = data
+        self._fixups = None
+
+
+    def peek(self, of, n=1):
+        """Return n bytes at offset, with fixups applied"""
+        b = bytes(self._buf[of:of+n])
+        if self._fixups:
+            b = bytes(self._fixups.get(of+i, c) for i, c in enumerate(b))
+        return b
+
+
     def len(self):
         return 1+self.end-self.start
 
 
     def datalen(self):
-        return len(self.data) if self.data is not None else 0
+        return len(self._buf) if self._buf is not None else 0
 
 
     def init_addr(self):
         if self.start <= 0x2E2 and self.end >= 0x2E3:
             of = 0x2E2 - self.start
-            init_addr = struct.unpack('<H', self.data[of:2+of])[0]
+            init_addr = struct.unpack('<H', self.peek(of, 2))[0]
         else:
             init_addr = None
         return init_addr
@@ -84,7 +346,7 @@ class Segment:
     def run_addr(self):
         if self.start <= 0x2E0 and self.end >= 0x2E1:
             of = 0x2E0 - self.start
-            run_addr = struct.unpack('<H', self.data[of:2+of])[0]
+            run_addr = struct.unpack('<H', self.peek(of, 2))[0]
         else:
             run_addr = None
         return run_addr
@@ -93,12 +355,20 @@ class Segment:
     def hint_byte(self):
         if self.start <= 0x2DF and self.end >= 0x2DF:
             of = 0x2DF - self.start
-            hint = self.data[of]
+            hint = self.peek(of)[0]
         else:
             hint = None
         return hint
 
 
+    def packed_header(self):
+        """Bytes of packed segment between 0x0000 and packed data"""
+        if self.version == 1:
+            return struct.pack('B', self.packer)
+        return bytes((PACKED_V2,)) + pack_word7(self.datalen()) + pack_word7(self.unpacked_end) \
+            + struct.pack('B', self.packer)
+
+
     def write(self, fout):
         if self.type == SEGMENT_SIGNATURE:
             self.write_data(fout)
@@ -109,13 +379,24 @@ class Segment:
         elif self.type == SEGMENT_PACKED:
             fout.write(struct.pack('<H', self.start))
             fout.write(struct.pack('<H', self.end))
-            fout.write(struct.pack('B', self.packer))
+            fout.write(self.packed_header())
             self.write_data(fout)
 
 
     def write_data(self, fout):
-        if self.data is not None:
-            fout.write(self.data)
+        if self._buf is None:
+            return
+        if not self._fixups:
+            fout.write(self._buf)
+            return
+        # write shared payload with fixups applied
+        view = memoryview(self._buf)
+        pos = 0
+        for of in sorted(self._fixups):
+            fout.write(view[pos:of])
+            fout.write(bytes((self._fixups[of],)))
+            pos = of + 1
+        fout.write(view[pos:])
 
 
     def pack(self, packer, tempfilename=None):
@@ -126,7 +407,23 @@ class Segment:
         if cmd_template is None:
             print(f"pack: unknown packer {packer:02X}")
             return None
-        tmpin = f"tmp-{self.start:04X}" if tempfilename is None else tempfilename
+        t = time.perf_counter()
+        if cache is not None:
+            # same bytes packed before, in watch mode
+            key = (packer, self.peek(0, self.datalen()))
+            found = cache.get(key)
+            if found is not None:
+                segment = self.packed_segment(packer, *found)
+                if metrics is not None:
+                    metrics.cache_hits += 1
+                    metrics.add_segment(self, segment, time.perf_counter() - t)
+                return segment
+        if tempfilename is None:
+            # unique temporary files, several packers may run in the same directory
+            fd, tmpin = tempfile.mkstemp(prefix=f"tmp-{self.start:04X}-", dir=".")
+            os.close(fd)
+        else:
+            tmpin = tempfilename
         tmpout = tmpin+"."+pn
         cmd = [arg.format(filein=tmpin, fileout=tmpout) for arg in cmd_template]
         cmd[0] = os.path.join(os.path.dirname(__file__), "pack", cmd[0])
@@ -148,13 +445,23 @@ class Segment:
             with open(tmpout, 'rb') as fin:
                 data = fin.read()
             if data is not None:
-                segment = Segment(SEGMENT_PACKED, self.start, 0)
-                segment.packer = packer
-                segment.data = data
-                segment.decomp_offset = self.len() - len(data) + delta
-                segment.source = self
+                segment = self.packed_segment(packer, data, delta)
+                if cache is not None:
+                    cache.put(key, (data, delta))
             os.unlink(tmpout)
         os.unlink(tmpin)
+        if metrics is not None:
+            metrics.add_segment(self, segment, time.perf_counter() - t)
+        return segment
+
+
+    def packed_segment(self, packer, data, delta):
+        segment = Segment(SEGMENT_PACKED, self.start, 0)
+        segment.packer = packer
+        segment.data = data
+        segment.decomp_offset = self.len() - len(data) + delta
+        segment.unpacked_end = self.end
+        segment.source = self
         return segment
 
 
@@ -168,8 +475,13 @@ class Segment:
             # keep original addresses for RUN and INIT segments
             segment = Segment(self.type, self.start, self.end)
         segment.source = self
-        # copy data bytes
-        segment.data = bytearray(self.data)
+        # share data bytes, relocation is recorded as fixups
+        segment._buf = self._buf
+        fixups = dict(self._fixups) if self._fixups else {}
+        segment._fixups = fixups
+        data = self._buf
+        def byte(of):
+            return fixups.get(of, data[of])
         # do relocation
         rel = -1 # relocation "pointer" to data
         ti = 0   # relocation table index
@@ -193,27 +505,27 @@ class Segment:
             ti += 1
             if rtype == REL_WORD:
                 # update word
-                w = struct.unpack('<H', segment.data[rel:rel+2])[0]
+                w = byte(rel) | byte(rel+1) << 8
                 w = (w + offset) & 0xFFFF
-                segment.data[rel] = w & 0xFF
-                segment.data[rel+1] = w >> 8
+                fixups[rel] = w & 0xFF
+                fixups[rel+1] = w >> 8
             elif rtype == REL_LOW:
                 # update low byte
-                b = segment.data[rel]
+                b = byte(rel)
                 b = (b + offset) & 0xFF
-                segment.data[rel] = b
+                fixups[rel] = b
             elif rtype == REL_HIGH:
                 # update high byte
                 if ti >= len(table):
                     print("Unexpected end of relocation table")
                     break
                 # build original word, get low byte from table
-                w = segment.data[rel] << 8 | table[ti]
+                w = byte(rel) << 8 | table[ti]
                 ti += 1
                 # apply offset
                 w = (w + offset) & 0xFFFF
                 # store high byte
-                segment.data[rel] = w >> 8
+                fixups[rel] = w >> 8
         return segment
 
 
@@ -234,46 +546,76 @@ class Ranges:
 
 class AtariDosObject:
 
+    __slots__ = ('segments',)
+
     def __init__(self):
         self.segments = []
 
 
-    def read_segment(self, fin):
-        w = fin.read(2)
-        if not w:
-            return None
+    def size(self):
+        """Size of file with all segments, in bytes"""
+        size = 0
+        for s in self.segments:
+            if s.type == SEGMENT_SIGNATURE:
+                size += 2
+            elif s.type == SEGMENT_DATA:
+                size += 4 + s.datalen()
+            elif s.type == SEGMENT_PACKED:
+                size += 4 + len(s.packed_header()) + s.datalen()
+        return size
+
+
+    def read_segment(self, buf, pos):
+        """Read segment at pos from file content, return segment and position of next one
+
+        Segment payload is a view of buf, not a copy.
+        """
+        if pos + 2 > len(buf):
+            return None, pos
 
-        block_start = struct.unpack('<H', w)[0]
+        block_start = struct.unpack_from('<H', buf, pos)[0]
         if block_start == 0xffff:
             s = Segment(SEGMENT_SIGNATURE)
-            s.data = b'\xff\xff'
-            return s
+            s.data = buf[pos:pos+2]
+            return s, pos+2
 
-        w = fin.read(2)
-        block_end = struct.unpack('<H', w)[0]
+        block_end = struct.unpack_from('<H', buf, pos+2)[0]
+        pos += 4
         if block_end == 0:
             s = Segment(SEGMENT_PACKED, block_start, block_end)
-            b = fin.read(1)
-            s.packer = b[0]
-            s.data = fin.read()
-            return s
+            if buf[pos] == PACKED_V2:
+                # v2, packed data length is known, other segments can follow
+                length = unpack_word7(buf[pos+1:pos+4])
+                s.unpacked_end = unpack_word7(buf[pos+4:pos+7])
+                s.packer = buf[pos+7]
+                pos += 8
+                s.data = buf[pos:pos+length]
+                return s, pos+length
+            # v1, packed data till the end of file
+            s.version = 1
+            s.packer = buf[pos]
+            s.data = buf[pos+1:]
+            return s, len(buf)
 
         s = Segment(SEGMENT_DATA, block_start, block_end)
-        s.data = fin.read(1+block_end-block_start)
-        return s
+        s.data = buf[pos:pos+1+block_end-block_start]
+        return s, pos+1+block_end-block_start
 
 
+    @measured('load')
     def load(self, filename):
         print(f'Reading file "{filename}"')
         self.segments = []
         with open(filename, 'rb') as fin:
-            s = self.read_segment(fin)
-            while s:
-                self.segments.append(s)
-                s = self.read_segment(fin)
+            buf = memoryview(fin.read())
+        s, pos = self.read_segment(buf, 0)
+        while s:
+            self.segments.append(s)
+            s, pos = self.read_segment(buf, pos)
         return self
 
 
+    @measured('save')
     def save(self, filename):
         print(f'Writing file "{filename}"')
         with open(filename, 'wb') as fout:
@@ -289,6 +631,29 @@ class AtariDosObject:
         return self
 
 
+    @measured('split')
+    def split(self, chunk_size):
+        """Split DATA segments longer than chunk_size into chunks of about the same size"""
+        obj = AtariDosObject()
+        for i, s in enumerate(self.segments):
+            if s.type != SEGMENT_DATA or s.len() <= chunk_size \
+                    or s.init_addr() is not None or s.run_addr() is not None:
+                obj.segments.append(s)
+                continue
+            n = (s.len() + chunk_size - 1) // chunk_size
+            print(f"Splitting segment {i} ({s.start:04X}-{s.end:04X}) into {n} chunks")
+            data = s.data
+            of = 0
+            for c in range(n):
+                size = (s.len() - of) // (n - c)
+                s2 = Segment(SEGMENT_DATA, s.start + of, s.start + of + size - 1)
+                s2.data = data[of:of+size]
+                obj.segments.append(s2)
+                of += size
+        return obj
+
+
+    @measured('pack')
     def pack(self, packer, min_size=128):
         packer_name = packers.get(packer, (None, None))[0]
         if packer_name is None:
@@ -312,6 +677,7 @@ class AtariDosObject:
         return obj
 
 
+    @measured('fix_init_order')
     def fix_init_order(self):
         """ATASM fix"""
         segments = self.segments
@@ -369,6 +735,7 @@ class AtariDosObject:
         return obj
 
 
+    @measured('relocate')
     def relocate(self, addr):
         """Relocate segments using segments with relocation table"""
         obj = AtariDosObject()
@@ -399,25 +766,30 @@ class AtariDosObject:
         return obj
 
 
-    def hybridize(self, stop_run=True):
+    @measured('hybridize')
+    def hybridize(self, stop_run=True, memlo=None, memtop=a8mem.MEMTOP, reserved=()):
         """Make packed segments DOS friendly"""
         obj = AtariDosObject()
         run_addr = None
         unpack = []
-        # due to current limits in unpacker pick just segment with most bytes saved by compression
-        max_saved =  0
-        candidate = -1
+        # unpacker is called at the end of file, program INIT called earlier must not run
+        # on packed data: segments before the last INIT segment and segments with INIT
+        # address stay unpacked
+        inits = [(i, s.init_addr()) for i,s in enumerate(self.segments)
+            if s.type == SEGMENT_DATA and s.init_addr() is not None]
+        last_init = max((i for i, a in inits), default=-1)
+        hybrid = [i for i,s in enumerate(self.segments) if s.type == SEGMENT_PACKED and i > last_init
+            and not any(s.start <= a <= s.unpacked_end for _, a in inits)]
+        # segment with most bytes saved by compression pays for the unpacker,
+        # any other one must save more than its hint, parameters and INIT segments
+        saved = {i: self.segments[i].source.datalen() - self.segments[i].datalen() for i in hybrid}
+        best = max(saved, key=saved.get, default=-1)
+        candidates = [i for i in saved if (i == best and saved[i] > 0) or saved[i] > HYBRID_SEGMENT_OVERHEAD]
+        if candidates:
+            print(f"Preparing hybrid ZX0/DOS file with packed segments {', '.join(str(i) for i in candidates)}")
         for i,s in enumerate(self.segments):
             if s.type == SEGMENT_PACKED:
-                saved = s.source.datalen() - s.datalen()
-                if saved > max_saved:
-                    candidate = i
-                    max_saved = saved
-        if (candidate >= 0):
-            print(f"Preparing hybrid ZX0/DOS file with packed segment {candidate}")
-        for i,s in enumerate(self.segments):
-            if s.type == SEGMENT_PACKED:
-                if i == candidate:
+                if i in candidates:
                     print(f"Hybridizing packed segment {i}")
                     s2 = Segment(SEGMENT_DATA, 0x2DF, 0x2E1)
                     # LOAD w/ UNPACK
@@ -466,27 +838,201 @@ class AtariDosObject:
             packer = unpack[0][0].packer
             pn, cmd_template, un_template = packers.get(packer, (None, None, None))
             unpacker_name = un_template[0]
-            unpacker_addr = max([s.end+1 for s in obj.segments])
             unpacker_file = os.path.join(os.path.dirname(__file__), "pack", "a8", unpacker_name)
-            unpacker = AtariDosObject().load(unpacker_file).relocate(unpacker_addr)
+            if cache is None:
+                unpacker = AtariDosObject().load(unpacker_file)
+            else:
+                unpacker = cache.unpacker(unpacker_file)
+            memmap = obj.memory_map(unpack, memlo, memtop, reserved)
+            unpacker_addr = memmap.alloc(unpacker.relocatable_size(), "unpacker")
+            print(f"Placing unpacker at {unpacker_addr:04X}")
+            if cache is None:
+                unpacker = unpacker.relocate(unpacker_addr)
+            else:
+                unpacker = cache.relocated_unpacker(unpacker, unpacker_addr)
             # TODO better!
             # modify decompressor segment, set parameters COMP_DATA and DECOMP_TO
-            # set DECOMP_TO, i.e. relocate 0xFFFF (-1) placeholder to RUNAD in segment 1
             unpacker_code_segment = unpacker.segments[1]
-            unpack_to = unpack[0][0].start
-            unpack_from = unpack[0][1].start
-            print(f"Patch unpacker: unpack to {unpack_to:04X}")
-            unpacker_code_segment = unpacker_code_segment.relocate(1 + unpack_to, un_template[1][0], header=False)
-            # set COMP_DATA, i.e. relocate 0xFFFF (-1) placeholder to start of segment 2
-            print(f"Patch unpacker: unpack from {unpack_from:04X}")
-            unpacker_code_segment = unpacker_code_segment.relocate(1 + unpack_from, un_template[1][1], header=False)
-            unpacker.segments[1] = unpacker_code_segment
-            # TODO add more segments if more segments needs to be decompressed:
-            # re-load COMP_DATA and DECOMP_TO parameters, add INIT to call unpacker
+            unpacker.segments[1] = self.unpacker_params(unpacker_code_segment, un_template[1], *unpack[0])
             obj.merge(unpacker)
+            # for other packed segments re-load COMP_DATA and DECOMP_TO parameters and call unpacker again
+            unpacker_init_segment = [s for s in unpacker.segments if s.init_addr() is not None][-1]
+            for s, s3 in unpack[1:]:
+                params = self.unpacker_params(unpacker_code_segment, un_template[1], s, s3)
+                s4 = Segment(SEGMENT_DATA, params.start, params.start + UNPACKER_PARAMS - 1)
+                s4.data = params.peek(0, UNPACKER_PARAMS)
+                obj.segments.append(s4)
+                obj.segments.append(unpacker_init_segment)
+        return obj
+
+
+    def unpacker_params(self, code, tables, s, s3):
+        """Return unpacker code segment with DECOMP_TO and COMP_DATA set for packed segment s"""
+        # set DECOMP_TO, i.e. relocate 0xFFFF (-1) placeholder to start of unpacked data
+        print(f"Patch unpacker: unpack to {s.start:04X}")
+        code = code.relocate(1 + s.start, tables[0], header=False)
+        # set COMP_DATA, i.e. relocate 0xFFFF (-1) placeholder to start of packed data
+        print(f"Patch unpacker: unpack from {s3.start:04X}")
+        return code.relocate(1 + s3.start, tables[1], header=False)
+
+
+    def memory_map(self, unpack, memlo=None, memtop=a8mem.MEMTOP, reserved=()):
+        """Build memory map of hybrid file, move packed data which cannot be unpacked in place
+
+        unpack is list of (packed segment, segment with packed data) pairs.
+        Without memlo free memory starts at the lowest program address at or
+        above MEMLO, programs loaded higher keep clear of DOS with higher MEMLO.
+        Reserved ranges (start, end) are not used for unpacker and packed data.
+        """
+        if memlo is None:
+            starts = [s.start for s, s3 in unpack] + [s.start for s in self.segments if s.type == SEGMENT_DATA]
+            memlo = min((a for a in starts if a >= a8mem.MEMLO), default=a8mem.MEMLO)
+        memmap = a8mem.MemoryMap(memlo, memtop)
+        for start, end in reserved:
+            memmap.mark(start, end, "reserved")
+        packed_data = [u[1] for u in unpack]
+        # memory used by program: unpacked data and all other data segments
+        for s, s3 in unpack:
+            memmap.mark(s.start, s.start + s.source.len() - 1, f"unpacked data {s.start:04X}")
+        for s in self.segments:
+            if s.type == SEGMENT_DATA and not any(s is p for p in packed_data):
+                memmap.mark(s.start, s.end, "program")
+        # packed data is loaded to the end of its unpacked data, nothing else may use that memory;
+        # segments are unpacked in order, memory of a later one is free until it is unpacked
+        moved = []
+        for i, (s, s3) in enumerate(unpack):
+            owner = f"packed data {s.start:04X}"
+            allow = [f"unpacked data {t.start:04X}" for t, t3 in unpack[i:]]
+            found = memmap.conflicts(s3.start, s3.end, allow=allow)
+            if not found:
+                unpacked_end = s.start + s.source.len() - 1
+                memmap.mark(max(s3.start, unpacked_end + 1), s3.end, owner)
+                continue
+            print(f"Packed data {s3.start:04X}-{s3.end:04X} overlaps {', '.join(found)}, cannot unpack in place")
+            moved.append((s3, owner))
+        # move packed data when all data unpacked in place is marked, moved one must not take its memory
+        for s3, owner in moved:
+            addr = memmap.alloc(s3.len(), owner)
+            print(f"Moving {owner} to {addr:04X}")
+            s3.end = addr + s3.len() - 1
+            s3.start = addr
+        return memmap
+
+
+    def check_reserved(self, reserved):
+        """Print segments loaded into reserved ranges (start, end), return False if there are any"""
+        ok = True
+        for s in self.segments:
+            if s.type == SEGMENT_DATA:
+                end = s.end
+            elif s.type == SEGMENT_PACKED:
+                end = s.end if s.unpacked_end is None else s.unpacked_end
+            else:
+                continue
+            for start, end2 in reserved:
+                if s.start <= end2 and start <= end:
+                    print(f"Segment {s.start:04X}-{end:04X} overlaps reserved memory {start:04X}-{end2:04X}")
+                    ok = False
+        return ok
+
+
+    def relocatable_size(self):
+        """Size of memory needed by segments which are relocated to new address"""
+        size = 0
+        for i, s in enumerate(self.segments):
+            if i+2 < len(self.segments) and self.segments[i+1].hint_byte() == 2 \
+                    and s.init_addr() is None and s.run_addr() is None:
+                size += s.len()
+        return size
+
+
+    def load_offsets(self):
+        """Return list of (start, end, offset) of loaded data, offset is file size when data is complete"""
+        ranges = []
+        size = 0
+        for s in self.segments:
+            if s.type == SEGMENT_SIGNATURE:
+                size += 2
+            elif s.type == SEGMENT_DATA:
+                size += 4 + s.datalen()
+                ranges.append((s.start, s.end, size))
+            elif s.type == SEGMENT_PACKED:
+                size += 4 + len(s.packed_header()) + s.datalen()
+                end = s.end if s.unpacked_end is None else s.unpacked_end
+                ranges.append((s.start, end, size))
+        return ranges
+
+
+    def chunk_stats(self, whole):
+        """Return (segment, chunks, size, chunked size, peak overlap, chunked peak overlap)
+        for packed segments of whole which are split into chunks in this file"""
+        stats = []
+        for s in whole.segments:
+            if s.type != SEGMENT_PACKED:
+                continue
+            end = s.start + s.source.len() - 1
+            chunks = [c for c in self.segments if s.start <= c.start <= end]
+            if len(chunks) < 2:
+                continue
+            size = 4 + len(s.packed_header()) + s.datalen()
+            size2 = 0
+            overlap2 = 0
+            for c in chunks:
+                if c.type == SEGMENT_PACKED:
+                    size2 += 4 + len(c.packed_header()) + c.datalen()
+                    overlap2 = max(overlap2, c.decomp_offset + c.datalen() - c.source.len())
+                else:
+                    size2 += 4 + c.datalen()
+            overlap = s.decomp_offset + s.datalen() - s.source.len()
+            stats.append((s, chunks, size, size2, overlap, overlap2))
+        return stats
+
+
+    def select_chunks(self, whole):
+        """Return file with chunks of segments where they save more overlap than they add bytes,
+        other segments as packed in whole"""
+        replaced = {}
+        for s, chunks, size, size2, overlap, overlap2 in self.chunk_stats(whole):
+            if overlap - overlap2 > size2 - size:
+                continue
+            end = s.start + s.source.len() - 1
+            print(f"Warning: chunks of segment {s.start:04X}-{end:04X} add {size2-size} bytes"
+                f" and save {overlap-overlap2} bytes of overlap, segment is packed without chunks")
+            replaced[id(chunks[0])] = s
+            for c in chunks[1:]:
+                replaced[id(c)] = None
+        obj = AtariDosObject()
+        for c in self.segments:
+            c = replaced.get(id(c), c)
+            if c is not None:
+                obj.segments.append(c)
         return obj
 
 
+    def print_chunk_report(self, whole, chunk_size):
+        """Compare chunked and packed file with packed file without chunks"""
+        print(f"\nChunks of {chunk_size} bytes")
+        for s, chunks, size, size2, overlap, overlap2 in self.chunk_stats(whole):
+            end = s.start + s.source.len() - 1
+            print(f"Segment {s.start:04X}-{end:04X}: {len(chunks)} chunks"
+                f", {size} -> {size2} bytes ({size2-size:+d}, {100*(size2-size)/size:+.1f}%)"
+                f", peak overlap {overlap} -> {overlap2} bytes")
+        # INIT routine can be called when data it starts at are loaded
+        offsets = whole.load_offsets()
+        offsets2 = self.load_offsets()
+        for s in whole.segments:
+            init_addr = s.init_addr() if s.type == SEGMENT_DATA else None
+            if init_addr is None:
+                continue
+            at = [o for rs, re_, o in offsets if rs <= init_addr <= re_]
+            at2 = [o for rs, re_, o in offsets2 if rs <= init_addr <= re_]
+            if at and at2:
+                print(f"INIT {init_addr:04X} available after {at2[0]} bytes of file (was {at[0]})")
+        size = whole.size()
+        size2 = self.size()
+        print(f"Total bytes: {size} -> {size2} ({size2-size:+d}, {100*(size2-size)/size:+.1f}%)\n")
+
+
     def print_info(self):
         data_bytes = 0
         control_bytes = 0
@@ -522,29 +1068,96 @@ class AtariDosObject:
                 )
 
             elif s.type == SEGMENT_PACKED:
-                control_bytes += 5
+                control_bytes += 4 + len(s.packed_header())
                 data_bytes += s.datalen()
                 p = packers.get(s.packer)
                 pname = p[0] if p else "unknown"
-                print(f"Segment {i}: {s.type} {s.start:04X}-{s.end:04X}"
+                end = s.end if s.unpacked_end is None else s.unpacked_end
+                print(f"Segment {i}: {s.type} v{s.version} {s.start:04X}-{end:04X}"
                     f" with {pname} ({s.packer:02X})"
                     f" {s.datalen()} bytes"
                 )
         print(f"Total segments: {len(self.segments)}  Total bytes: {control_bytes+data_bytes}\n")
 
 
+def pack_chunked(obj, chunk_size):
+    """Pack segments, split to chunks first if chunk_size is given
+
+    Chunks are kept only for segments where they pay off, see select_chunks().
+    """
+    if chunk_size is None:
+        return obj.pack(PACK_ZX0)
+    packed = obj.split(chunk_size).pack(PACK_ZX0)
+    # pack without chunks to see what chunks cost and bring
+    print("Packing without chunks for comparison")
+    whole = obj.pack(PACK_ZX0)
+    packed.print_chunk_report(whole, chunk_size)
+    return packed.select_chunks(whole)
+
+
 def main():
+    global cache
     o_verbose = False
     o_initfix = False
+    o_version = 2
+    o_metrics = None
+    o_profile = None
+    o_memlo = None
+    o_memtop = a8mem.MEMTOP
+    o_reserve = []
+    o_chunk = None
+    o_watch = False
+    o_atr = None
     a_filein = None
     a_fileout = None
     action = ''
 
-    for arg in sys.argv[1:]:
-        if arg == '-v':
+    args = sys.argv[1:]
+    while args:
+        arg = args.pop(0)
+        if arg in ('--metrics', '--profile', '--atr'):
+            if not args:
+                print(f'Option {arg} requires file name')
+                sys.exit(1)
+            if arg == '--metrics':
+                o_metrics = args.pop(0)
+            elif arg == '--atr':
+                o_atr = args.pop(0)
+            else:
+                o_profile = args.pop(0)
+        elif arg in ('--memlo', '--memtop'):
+            try:
+                addr = a8mem.parse_addr(args.pop(0))
+            except (ValueError, IndexError):
+                print(f'Option {arg} requires address')
+                sys.exit(1)
+            if arg == '--memlo':
+                o_memlo = addr
+            else:
+                o_memtop = addr
+        elif arg == '--reserve':
+            try:
+                start, end = (a8mem.parse_addr(a) for a in args.pop(0).split('-'))
+            except (ValueError, IndexError):
+                print(f'Option {arg} requires address range START-END')
+                sys.exit(1)
+            o_reserve.append((start, end))
+        elif arg == '--chunk':
+            try:
+                o_chunk = int(args.pop(0), 0)
+            except (ValueError, IndexError):
+                o_chunk = 0
+            if o_chunk < 128:
+                print(f'Option {arg} requires chunk size, at least 128 bytes')
+                sys.exit(1)
+        elif arg == '--watch':
+            o_watch = True
+        elif arg == '-v':
             o_verbose = True
         elif arg == '-f':
             o_initfix = True
+        elif arg == '--v1':
+            o_version = 1
         elif arg == '-i':
             action = 'info'
         elif arg == '-c':
@@ -579,49 +1192,157 @@ def main():
         print("Input file names must be specified.")
         sys.exit(1)
 
-    # read input file
-    obj = AtariDosObject().load(a_filein)
-
-    #
-    # perfrom action
-    #
-    if action == 'info':
-        obj.print_info()
+    if o_watch or o_atr is not None:
+        if action == 'info' or a_fileout is None:
+            print("With --watch or --atr an output file name must be specified.")
+            sys.exit(1)
 
-    elif action == 'initfix':
-        if o_verbose:  obj.print_info()
+    def run():
+        """Read input file, perform action, write output file, return False on failure"""
+        global metrics
+        if o_metrics is not None or o_profile is not None:
+            metrics = Metrics(o_profile)
 
-        obj = obj.fix_init_order()
-        if o_verbose: obj.print_info()
+        # read input file
+        obj = AtariDosObject().load(a_filein)
 
-        obj.save(a_fileout)
+        #
+        # perfrom action
+        #
+        if action == 'info':
+            obj.print_info()
 
-    elif action == 'pack':
-        if o_verbose:  obj.print_info()
+        elif action == 'initfix':
+            if o_verbose:  obj.print_info()
 
-        if o_initfix:
             obj = obj.fix_init_order()
             if o_verbose: obj.print_info()
 
-        obj = obj.pack(PACK_ZX0)
-        if o_verbose: obj.print_info()
+            obj.save(a_fileout)
 
-        obj.save(a_fileout)
+        elif action == 'pack':
+            if o_verbose:  obj.print_info()
+            if not obj.check_reserved(o_reserve):
+                return False
 
-    elif action == 'packhybrid':
-        if o_verbose:  obj.print_info()
+            if o_initfix:
+                obj = obj.fix_init_order()
+                if o_verbose: obj.print_info()
 
-        if o_initfix:
-            obj = obj.fix_init_order()
+            obj = pack_chunked(obj, o_chunk)
+            for s in obj.segments:
+                if s.type == SEGMENT_PACKED:
+                    s.version = o_version
             if o_verbose: obj.print_info()
 
-        obj = obj.pack(PACK_ZX0)
-        if o_verbose: obj.print_info()
+            obj.save(a_fileout)
+
+        elif action == 'packhybrid':
+            if o_verbose:  obj.print_info()
+            if not obj.check_reserved(o_reserve):
+                return False
 
-        obj = obj.hybridize()
-        if o_verbose: obj.print_info()
+            if o_initfix:
+                obj = obj.fix_init_order()
+                if o_verbose: obj.print_info()
 
-        obj.save(a_fileout)
+            obj = pack_chunked(obj, o_chunk)
+            if o_verbose: obj.print_info()
+
+            try:
+                obj = obj.hybridize(memlo=o_memlo, memtop=o_memtop, reserved=o_reserve)
+            except a8mem.LayoutError as e:
+                print(f"Cannot place unpacker or packed data: {e}")
+                return False
+            if o_verbose: obj.print_info()
+
+            obj.save(a_fileout)
+
+        if o_metrics is not None:
+            metrics.save(o_metrics)
+
+        if o_atr is not None:
+            return patch_atr(o_atr, a_fileout)
+        return True
+
+    if not o_watch:
+        if not run():
+            sys.exit(1)
+        return
+
+    cache = PackCache()
+    files = [a_filein]
+    if action == 'packhybrid':
+        files.append(os.path.join(os.path.dirname(__file__), "pack", "a8", packers[PACK_ZX0][2][0]))
+    watch(files, run)
+
+
+def patch_atr(atrfn, filename):
+    """Write file into ATR image in place of file with the same name, update config loader"""
+    name = os.path.basename(filename)
+    try:
+        with open(atrfn, 'rb') as fin:
+            atr = bytearray(fin.read())
+        with open(filename, 'rb') as fin:
+            data = fin.read()
+        count = update_atr.replace_file(atr, name, data)
+        print(f'Patching "{atrfn}": "{name}" {count} sectors')
+        if update_atr.find_dentry(atr, LOADER_FILE) is not None:
+            update_atr.update_loader(atr, LOADER_FILE, name)
+        with open(atrfn, 'wb') as fout:
+            fout.write(atr)
+    except (OSError, ValueError) as e:
+        print(f'Failed to patch "{atrfn}": {e}')
+        return False
+    return True
+
+
+def watch(filenames, rebuild):
+    """Call rebuild whenever one of files changes, until interrupted"""
+    def stamp():
+        result = []
+        for fn in filenames:
+            try:
+                st = os.stat(fn)
+                result.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                # file is being replaced
+                result.append(None)
+        return result
+
+    def timed_rebuild():
+        cache.hits = cache.misses = 0
+        t = time.perf_counter()
+        try:
+            ok = rebuild()
+        except (OSError, IndexError, struct.error) as e:
+            print(f"Failed to read input: {e}")
+            ok = False
+        elapsed = time.perf_counter() - t
+        print(f"{'Rebuilt' if ok else 'Rebuild failed'} in {1000*elapsed:.0f} ms"
+            f", {cache.hits} of {cache.hits + cache.misses} segments from cache")
+        if ok:
+            # after failed rebuild segments of the last good one are kept
+            cache.prune()
+
+    last = stamp()
+    timed_rebuild()
+    print(f"Watching {', '.join(filenames)}, press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            now = stamp()
+            if now == last or None in now:
+                continue
+            # file may be still written, wait until it does not change
+            time.sleep(WATCH_INTERVAL)
+            if stamp() != now:
+                continue
+            last = now
+            print(f"\nChange detected, {time.strftime('%H:%M:%S')}")
+            timed_rebuild()
+    except KeyboardInterrupt:
+        print("Stopped watching")
 
 
 def print_help():
@@ -630,12 +1351,35 @@ Usage: a8pack.py [options] input_file [output_file]
   -i      Print file info
   -c      Compress file segments
           to load a file a special loader which supports decompression is needed
+  --v1    With -c write packed segments in format v1 (without length), for older loaders
   -d      Compress file segments, append decompression routine
           produced file is in Atari DOS compatible format
+  --chunk SIZE
+          With -c or -d split segments longer than SIZE bytes into chunks
+          which are packed separately, report size, overlap and INIT changes;
+          chunks are kept only if they save more overlap than they add bytes
   -f      Fix order of INIT segments (for files produced by ATASM)
           Can be combined with -c or -d
   -v      Verbose output
   -h      Print this help
+  --metrics FILE
+          Write time, size and segment count of each pass and packer time
+          of each segment to FILE, as CSV if FILE ends with .csv, JSON otherwise
+  --profile DIR
+          Profile each pass with cProfile, write stats to DIR/<nn>-<pass>.prof
+  --memlo ADDR, --memtop ADDR
+          Free memory for unpacker and moved packed data (default from the
+          lowest program address at or above $2000 up to $BC1F)
+  --reserve START-END
+          With -c or -d fail if file loads into this memory, with -d it is
+          not used for unpacker and packed data; can be given more times
+  --watch Keep running, write output file again whenever input file changes
+          Packed segments and unpacker are kept in memory, only segments
+          with changed bytes are packed again
+  --atr FILE
+          Write output file into ATR image FILE in place of the file with the
+          same name, it can shrink but not grow; CLOADER.ZX0 is updated with
+          new size as update-atr.py does
 """)
 
 
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+
+#  a8timing.py - Boot timeline of instrumented config loader
+#    extracts timing log of config loader built with TIMING from memory
+#    dump, prints timeline, phases and histogram of sector read times
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+#
+# Usage: a8timing.py [options] memory.dump
+#
+# Build config loader with "make TIMING=1" (or tools/build.py --timing), boot
+# it and dump memory when CONFIG is started, e.g. with tools/a8emu.py --save-mem
+# or with monitor of emulator. Once running, CONFIG may use the memory of log. Log layout is described in src/timing.src.
+#
+# Time of entry is RTCLOK (frames since cold start) plus position of the beam
+# since VBI (VCOUNT), resolution is 2 scan lines.
+#
+
+
+import sys
+import os
+import json
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, TOOLS_DIR)
+from a8mem import parse_addr
+
+TLOG = 0x7900                   # see src/timing.src
+TLOGSEC = 255 - 8               # read and INIT events stop at this number of entries
+SIGNATURE = b"TLOG"
+TABLES = ('id', 'arg', 'lo', 'hi', 'vcount')    # one page each, from TLOG+$100
+
+SCANLINE = 114
+LINES_NTSC = 262
+LINES_PAL = 312
+CLOCK_NTSC = 1789773
+CLOCK_PAL = 1773447
+VBI_LINE = 248                  # RTCLOK is incremented in VBI, VCOUNT = 124
+
+# event id -> name, keep in sync with src/timing.src
+EV_DL = 0x01
+EV_SCREEN = 0x02
+EV_HSDET = 0x03
+EV_HSDONE = 0x04
+EV_LOACFG = 0x05
+EV_LOADED = 0x06
+EV_RUN = 0x07
+EV_READ = 0x10
+EV_RDONE = 0x11
+EV_INIT = 0x12
+EV_IDONE = 0x13
+
+EVENTS = {
+    EV_DL: "display part INIT",
+    EV_SCREEN: "display list on",
+    EV_HSDET: "get high speed index",
+    EV_HSDONE: "high speed index received",
+    EV_LOACFG: "CONFIG load started",
+    EV_LOADED: "CONFIG loaded",
+    EV_RUN: "CONFIG started",
+    EV_READ: "sector read",
+    EV_RDONE: "sector read done",
+    EV_INIT: "INIT",
+    EV_IDONE: "INIT returned",
+}
+
+# phase starts with event, the first one starts at cold start
+PHASES = {
+    None: "boot (OS, boot loader, display part)",
+    EV_DL: "display setup",
+    EV_SCREEN: "loading config loader",
+    EV_HSDET: "high speed detection",
+    EV_HSDONE: "loading rest with HISIO",
+    EV_LOACFG: "CONFIG",
+    EV_LOADED: "cleanup",
+}
+
+
+class TimingLog:
+    """Timing log of config loader, list of (event, argument, frame) entries"""
+
+    def __init__(self, entries, pal=False):
+        self.entries = entries
+        self.pal = pal
+        self.lines = LINES_PAL if pal else LINES_NTSC
+        self.ms_per_frame = 1000 * self.lines * SCANLINE / (CLOCK_PAL if pal else CLOCK_NTSC)
+
+
+    @classmethod
+    def from_dump(cls, data, base=0, addr=TLOG, pal=None):
+        """Extract log from memory dump, base is address of first byte of dump"""
+        of = addr - base
+        if of < 0 or of + 0x100 * (1 + len(TABLES)) > len(data):
+            raise ValueError(f"log at {addr:04X}-{addr+0x5FF:04X} is not in dump"
+                f" ({base:04X}-{base+len(data)-1:04X})")
+        if data[of:of+4] != SIGNATURE:
+            raise ValueError(f"no timing log at {addr:04X}, is config loader built with TIMING?")
+        count = data[of+4]
+        if pal is None:
+            pal = data[of+5] == 1
+        lines = LINES_PAL if pal else LINES_NTSC
+        tables = {name: data[of+0x100*(i+1):of+0x100*(i+2)] for i, name in enumerate(TABLES)}
+        entries = []
+        for i in range(count):
+            line = (2 * tables['vcount'][i] - VBI_LINE) % lines
+            frame = (tables['hi'][i] << 8 | tables['lo'][i]) + line / lines
+            entries.append((tables['id'][i], tables['arg'][i], frame))
+        return cls(entries, pal)
+
+
+    def ms(self, frames):
+        return frames * self.ms_per_frame
+
+
+    def sectors(self):
+        """Sector numbers of read events, only low byte is logged"""
+        result = {}
+        high = 0
+        last = None
+        for i, (ev, arg, _) in enumerate(self.entries):
+            if ev != EV_READ:
+                continue
+            if last is not None and arg < last and last - arg > 128:
+                high += 256
+            result[i] = high + arg
+            last = arg
+        return result
+
+
+    def reads(self):
+        """Sector reads as list of (entry index, sector, start frame, end frame, status)"""
+        sectors = self.sectors()
+        result = []
+        start = None
+        for i, (ev, arg, frame) in enumerate(self.entries):
+            if ev == EV_READ:
+                start = (i, frame)
+            elif ev == EV_RDONE and start is not None:
+                result.append((start[0], sectors[start[0]], start[1], frame, arg))
+                start = None
+        return result
+
+
+    def timeline(self):
+        sectors = self.sectors()
+        rows = []
+        prev = 0.0
+        for i, (ev, arg, frame) in enumerate(self.entries):
+            name = EVENTS.get(ev, f"event ${ev:02X}")
+            if ev == EV_READ:
+                name += f" {sectors[i]}"
+            elif ev in (EV_RDONE, EV_HSDONE):
+                name += f", status ${arg:02X}"
+            elif ev == EV_INIT:
+                name += f" ${arg:02X}xx"
+            rows.append({'frame': round(frame, 2), 'ms': round(self.ms(frame), 1),
+                'delta_ms': round(self.ms(frame - prev), 1), 'event': name})
+            prev = frame
+        return rows
+
+
+    def phases(self):
+        """Phases between loader events, with time spent in sector reads"""
+        bounds = [(None, 0.0)] + [(ev, frame) for ev, _, frame in self.entries if ev in PHASES]
+        end = self.entries[-1][2] if self.entries else 0.0
+        reads = self.reads()
+        result = []
+        for n, (ev, start) in enumerate(bounds):
+            stop = bounds[n+1][1] if n + 1 < len(bounds) else end
+            if ev == EV_RUN or (n + 1 == len(bounds) and stop == start):
+                break
+            r = [x for x in reads if start <= x[2] < stop]
+            sio = sum(x[3] - x[2] for x in r)
+            result.append({
+                'phase': PHASES[ev],
+                'start': round(start, 2),
+                'frames': round(stop - start, 2),
+                'ms': round(self.ms(stop - start), 1),
+                'reads': len(r),
+                'retries': len(r) - len(set(x[1] for x in r)),
+                'sio_ms': round(self.ms(sio), 1),
+            })
+        return result
+
+
+    def histogram(self, values, bucket):
+        """Counts of values (ms) in buckets of given width, list of (from, to, count)"""
+        if not values:
+            return []
+        counts = {}
+        for v in values:
+            b = int(v // bucket)
+            counts[b] = counts.get(b, 0) + 1
+        return [(b * bucket, (b + 1) * bucket, counts.get(b, 0)) for b in range(min(counts), max(counts) + 1)]
+
+
+    def report(self, bucket=2.0):
+        reads = self.reads()
+        read_ms = [self.ms(x[3] - x[2]) for x in reads]
+        # time between end of read and next read, decompression and progress bar
+        gap_ms = [self.ms(b[2] - a[3]) for a, b in zip(reads, reads[1:])]
+        return {
+            'entries': len(self.entries),
+            'full': len(self.entries) >= TLOGSEC,
+            'pal': self.pal,
+            'timeline': self.timeline(),
+            'phases': self.phases(),
+            'reads': [{'sector': s, 'start': round(t0, 2), 'ms': round(self.ms(t1 - t0), 2), 'status': st}
+                for _, s, t0, t1, st in reads],
+            'read_histogram': self.histogram(read_ms, bucket),
+            'gap_histogram': self.histogram(gap_ms, bucket),
+        }
+
+
+def print_histogram(title, hist, width=50):
+    print(title)
+    if not hist:
+        print("  none")
+        return
+    top = max(c for _, _, c in hist)
+    empty = False
+    for lo, hi, c in hist:
+        if not c:
+            if not empty:
+                print("  ...")      # run of empty buckets
+            empty = True
+            continue
+        empty = False
+        bar = '#' * ((c * width + top - 1) // top)
+        print(f"  {lo:6.1f} - {hi:6.1f} ms {c:5} {bar}")
+
+
+def print_report(r):
+    print(f"Timing log: {r['entries']} entries, {'PAL' if r['pal'] else 'NTSC'}"
+        + (", log is full, later reads and INIT calls are missing" if r['full'] else ""))
+    print("Timeline:")
+    print(f"  {'frame':>8} {'ms':>8} {'+ms':>7}  event")
+    for row in r['timeline']:
+        print(f"  {row['frame']:8.2f} {row['ms']:8.1f} {row['delta_ms']:7.1f}  {row['event']}")
+    print("Phases:")
+    print(f"  {'phase':36} {'start':>7} {'frames':>7} {'ms':>8} {'reads':>5} {'in SIO ms':>9}")
+    for p in r['phases']:
+        retries = f", {p['retries']} retries" if p['retries'] else ""
+        print(f"  {p['phase']:36} {p['start']:7.2f} {p['frames']:7.2f} {p['ms']:8.1f} {p['reads']:5} {p['sio_ms']:9.1f}{retries}")
+    print_histogram("Sector read time:", r['read_histogram'])
+    print_histogram("Time between sector reads (decompression, progress bar):", r['gap_histogram'])
+
+
+def main():
+    o_base = 0
+    o_addr = TLOG
+    o_pal = None
+    o_bucket = 2.0
+    o_json = None
+    files = []
+
+    args = sys.argv[1:]
+    while args:
+        arg = args.pop(0)
+        try:
+            if arg == '--base':
+                o_base = parse_addr(args.pop(0))
+            elif arg == '--addr':
+                o_addr = parse_addr(args.pop(0))
+            elif arg == '--pal':
+                o_pal = True
+            elif arg == '--ntsc':
+                o_pal = False
+            elif arg == '--bucket':
+                o_bucket = float(args.pop(0))
+                if o_bucket <= 0:
+                    raise ValueError
+            elif arg == '--json':
+                o_json = args.pop(0)
+            elif arg == '-h':
+                print_help()
+                sys.exit(0)
+            elif arg[0] == '-':
+                print(f'Unknown option: "{arg}"')
+                sys.exit(1)
+            else:
+                files.append(arg)
+        except (IndexError, ValueError):
+            print(f'Option {arg} requires a value')
+            sys.exit(1)
+
+    if len(files) != 1:
+        print_help()
+        sys.exit(1)
+
+    try:
+        with open(files[0], 'rb') as f:
+            data = f.read()
+        log = TimingLog.from_dump(data, o_base, o_addr, o_pal)
+    except (OSError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+    r = log.report(o_bucket)
+    print_report(r)
+    if o_json is not None:
+        with open(o_json, 'w') as f:
+            json.dump(r, f, indent=2)
+            f.write('\n')
+
+
+def print_help():
+    print("""Boot timeline of config loader built with TIMING
+Usage: a8timing.py [options] memory.dump
+  memory.dump   Memory dump with timing log, e.g. from a8emu.py --save-mem
+Options:
+  --base ADDR   Address of the first byte of dump (default 0)
+  --addr ADDR   Address of timing log (default $7900)
+  --pal         PAL machine (default: as recorded in log)
+  --ntsc        NTSC machine (default: as recorded in log)
+  --bucket MS   Width of histogram bucket in milliseconds (default 2)
+  --json FILE   Write results to FILE
+  -h            Print this help
+""")
+
+
+if __name__ == '__main__':
+    main()
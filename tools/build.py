@@ -0,0 +1,484 @@
+#!/usr/bin/env python3
+
+#  build.py - Content hashed parallel build for FujiNet Config Loader
+#    runs ATASM, a8pack and relgen steps of src/Makefile concurrently
+#    and skips steps whose inputs, tools and defines did not change
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+#
+# Usage: build.py [options] [target ...]
+#  targets - all (default), dist, clean or any step name (e.g. cloader.zx0)
+#
+# Each step is identified by a key, SHA-256 over the step commands (incl. ATASM
+# defines), content of all step inputs (sources found via .include / .incbin
+# are added automatically) and content of tools used by the step. Keys of built
+# steps are kept in src/.build-cache.json, a step is skipped if its key matches
+# and all its outputs exist. Since the key depends on content, not on mtime,
+# a step which produces the same output as before does not trigger rebuild of
+# dependent steps.
+#
+
+
+import sys
+import os
+import re
+import glob
+import json
+import shutil
+import hashlib
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TOOLS_DIR)
+SRC_DIR = os.path.join(ROOT_DIR, "src")
+
+ATASM = os.path.join(TOOLS_DIR, "atasm", "atasm")
+ZX0 = os.path.join(TOOLS_DIR, "pack", "zx0")
+A8PACK = os.path.join(TOOLS_DIR, "a8pack.py")
+RELGEN = os.path.join(TOOLS_DIR, "relgen.py")
+A8MEM = os.path.join(TOOLS_DIR, "a8mem.py")
+UPDATE_ATR = os.path.join(TOOLS_DIR, "update-atr.py")
+# a8pack.py imports a8mem.py and loads update-atr.py, relgen.py imports a8mem.py
+A8PACK_TOOLS = [A8PACK, A8MEM, UPDATE_ATR]
+DIR2ATR = "dir2atr"
+
+ZX0UNPACK = os.path.join(TOOLS_DIR, "pack", "a8", "zx0unpack.obj")
+CONFIG_COM = os.path.join(ROOT_DIR, "..", "fujinet-config", "config.com")
+CONFIG_TOOLS = os.path.join(ROOT_DIR, "..", "fujinet-config-tools", "atari", "dist")
+DIST_DIR = os.path.join(ROOT_DIR, "dist")
+ATR_FILE = os.path.join(ROOT_DIR, "autorun-zx0.atr")
+
+CACHE_FILE = os.path.join(SRC_DIR, ".build-cache.json")
+
+ASMFLAGS = ["-Ihisio"]
+INCLUDE_RE = re.compile(r'^\s*\.(?:include|incbin)\s+"([^"]+)"', re.I | re.M)
+
+# default targets, same as "make all" in src directory
+ALL = ["zx0unpack", "zx0boot.bin", "cloader.zx0", "config.com"]
+
+
+def file_hash(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def asm_sources(source, flags):
+    """Return source file and all files it includes, recursively"""
+    inc_dirs = [SRC_DIR] + [os.path.join(SRC_DIR, f[2:]) for f in flags if f.startswith("-I")]
+    found = []
+    todo = [os.path.join(SRC_DIR, source)]
+    while todo:
+        fn = todo.pop()
+        if fn in found:
+            continue
+        found.append(fn)
+        if not fn.endswith((".src", ".inc")):
+            continue # binary data from .incbin
+        with open(fn, 'r', errors='replace') as f:
+            text = f.read()
+        for name in INCLUDE_RE.findall(text):
+            for d in inc_dirs:
+                path = os.path.normpath(os.path.join(d, name))
+                if os.path.exists(path):
+                    todo.append(path)
+                    break
+            else:
+                print(f'{source}: cannot find included file "{name}"')
+    return found
+
+
+class Step:
+
+    def __init__(self, name, outputs, inputs=(), commands=(), tools=(), text=None, asm=None):
+        self.name = name
+        self.outputs = [os.path.normpath(os.path.join(SRC_DIR, o)) for o in outputs]
+        self.inputs = [os.path.normpath(os.path.join(SRC_DIR, i)) for i in inputs]
+        self.commands = list(commands) # argv lists, run from src directory, or callables
+        self.tools = list(tools)
+        self.text = text
+        self.asm = asm # (source, flags) to scan for included files
+        self.deps = []
+
+
+    def key(self):
+        h = hashlib.sha256()
+        for cmd in self.commands:
+            h.update(repr(cmd if not callable(cmd) else cmd.__name__).encode())
+        inputs = list(self.inputs)
+        if self.asm is not None:
+            inputs += asm_sources(*self.asm)
+        for fn in sorted(set(inputs)) + self.tools:
+            h.update(os.path.relpath(fn, ROOT_DIR).encode())
+            h.update(file_hash(fn).encode() if os.path.exists(fn) else b"missing")
+        return h.hexdigest()
+
+
+    def build(self, builder):
+        missing = [i for i in self.inputs if not os.path.exists(i)]
+        if missing:
+            builder.report(self, "".join(f'Missing input file "{i}"\n' for i in missing), False)
+            return False
+        try:
+            key = self.key()
+        except OSError as e:
+            builder.report(self, f"{self.name}: {e}\n", False)
+            return False
+        if not builder.force and builder.cache.get(self.name) == key \
+                and all(os.path.exists(o) for o in self.outputs):
+            builder.report(self, None, True, skipped=True)
+            return True
+        out = []
+        ok = True
+        for cmd in self.commands:
+            if callable(cmd):
+                try:
+                    out.append(cmd() or "")
+                except (OSError, subprocess.CalledProcessError) as e:
+                    out.append(f"{e}\n")
+                    ok = False
+            else:
+                if builder.verbose:
+                    out.append(" ".join(cmd) + "\n")
+                p = subprocess.run(cmd, cwd=SRC_DIR, stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT, universal_newlines=True)
+                out.append(p.stdout)
+                if p.returncode != 0:
+                    out.append(f"{self.name}: command failed with exit code {p.returncode}\n")
+                    ok = False
+            if not ok:
+                break
+        if ok:
+            builder.store(self.name, key)
+        builder.report(self, "".join(out), ok)
+        return ok
+
+
+def concat(output, inputs):
+    def cat():
+        with open(os.path.join(SRC_DIR, output), 'wb') as fout:
+            for fn in inputs:
+                with open(os.path.join(SRC_DIR, fn), 'rb') as fin:
+                    fout.write(fin.read())
+    cat.__name__ = f"cat {' '.join(inputs)} > {output}"
+    return cat
+
+
+def config_tools():
+    return sorted(glob.glob(os.path.join(CONFIG_TOOLS, "*.COM")) + glob.glob(os.path.join(CONFIG_TOOLS, "*.com")))
+
+
+def make_dist():
+    out = []
+    shutil.rmtree(DIST_DIR, ignore_errors=True)
+    os.makedirs(DIST_DIR)
+    for fn in ["cloader.zx0", "config.com"]:
+        shutil.copy(os.path.join(SRC_DIR, fn), DIST_DIR)
+    for fn in config_tools():
+        shutil.copy(fn, DIST_DIR)
+    if os.path.exists(ATR_FILE):
+        os.unlink(ATR_FILE)
+    for cmd in [[DIR2ATR, "-m", "-S", "-B", os.path.join(SRC_DIR, "zx0boot.bin"), ATR_FILE, DIST_DIR],
+                [sys.executable, UPDATE_ATR, ATR_FILE, "cloader.zx0", "config.com"]]:
+        out.append(subprocess.check_output(cmd, stderr=subprocess.STDOUT, universal_newlines=True))
+    return "".join(out)
+make_dist.__name__ = "dist"
+
+
+def unpacker_step(addr, zx0flags):
+    base = f"zx0unpack-{addr:04X}"
+    lst = ["-gzx0unpack.lst"] if addr == 0x1000 else []
+    flags = ASMFLAGS + zx0flags + ["-dUNPACKER=1", f"-dUNPACKSTART={addr}"]
+    return Step(base,
+        outputs=[f"{base}.obj", f"{base}-f.obj"] + ["zx0unpack.lst"] * len(lst),
+        commands=[
+            [ATASM] + flags + lst + [f"-o{base}.obj", "zx0unpack.src"],
+            [sys.executable, A8PACK, "-f", f"{base}.obj", f"{base}-f.obj"],
+        ],
+        tools=[ATASM] + A8PACK_TOOLS,
+        asm=("zx0unpack.src", flags),
+    )
+
+
+CLOADER_PARTS = {"dl": "display", "lo": "low", "hi": "high"}
+
+
+def cloader_step(part, defines):
+    flags = ASMFLAGS + defines
+    return Step(f"cloader-{part}.obj",
+        text=f"Building config loader - {CLOADER_PARTS[part]} part",
+        outputs=[f"cloader-{part}.obj", f"cloader-{part}.lst"],
+        commands=[[ATASM] + flags + [f"-gcloader-{part}.lst", f"-ocloader-{part}.obj", f"cloader-{part}.src"]],
+        tools=[ATASM],
+        asm=(f"cloader-{part}.src", flags),
+    )
+
+
+def build_steps(overlap=False, compact=False, timing=False, burst=False):
+    """Build steps, same as in src/Makefile and "dist" target of top level Makefile"""
+    zx0flags = [] if compact else ["-dZX0FAST=1"]
+    clflags = ["-dHIGHSPEED=1"] + zx0flags + (["-dOVERLAP=1"] if overlap else [])
+    clflags += ["-dTIMING=1"] if timing else []
+    clflags += ["-dBURST=1"] if burst else []
+    # CONFIG must not load to memory of loader (CLMEMEND in src/cloader-hi.src)
+    # and to timing code and log (src/timing.src)
+    cfgflags = ["--reserve", "0x0400-0x13FF"]
+    cfgflags += ["--reserve", "0x7800-0x7EFF"] if timing else []
+    steps = [
+        Step("tools",
+            text="Building tools",
+            outputs=[ATASM, ZX0],
+            commands=[["make", "-C", TOOLS_DIR, "all"]],
+        ),
+        unpacker_step(0x1000, zx0flags),
+        unpacker_step(0x1201, zx0flags),
+        Step("zx0unpack",
+            text="Building relocatable ZX0 decompressor",
+            outputs=[ZX0UNPACK],
+            inputs=["zx0unpack-1000-f.obj", "zx0unpack-1201-f.obj"],
+            commands=[[sys.executable, RELGEN, "zx0unpack-1000-f.obj", "zx0unpack-1201-f.obj", ZX0UNPACK]],
+            tools=[RELGEN, A8MEM],
+        ),
+        Step("zx0boot.bin",
+            text="Building boot loader",
+            outputs=["zx0boot.bin", "zx0boot.lst"],
+            commands=[[ATASM] + ASMFLAGS + ["-r", "-gzx0boot.lst", "-ozx0boot.bin", "zx0boot.src"]],
+            tools=[ATASM],
+            asm=("zx0boot.src", ASMFLAGS),
+        ),
+        cloader_step("dl", clflags + ["-dPARTDL=1"]),
+        cloader_step("lo", clflags),
+        cloader_step("hi", clflags + ["-dPARTHI=1"]),
+        Step("cloader.obj",
+            outputs=["cloader.obj"],
+            inputs=["cloader-dl.obj", "cloader-lo.obj", "cloader-hi.obj"],
+            commands=[concat("cloader.obj", ["cloader-dl.obj", "cloader-lo.obj", "cloader-hi.obj"])],
+        ),
+        Step("cloader.zx0",
+            text="Building config loader - ZX0 compressed",
+            outputs=["cloader.zx0"],
+            inputs=["cloader.obj"],
+            commands=[[sys.executable, A8PACK, "-c", "-f", "-v", "cloader.obj", "cloader.zx0"]],
+            tools=A8PACK_TOOLS + [ZX0],
+        ),
+        Step("config.com",
+            text="Building compressed CONFIG",
+            outputs=["config.com"],
+            inputs=[CONFIG_COM, ZX0UNPACK],
+            commands=[[sys.executable, A8PACK, "-d", "-v"] + cfgflags + [CONFIG_COM, "config.com"]],
+            tools=A8PACK_TOOLS + [ZX0],
+        ),
+        Step("dist",
+            text="Building ATR disk image",
+            outputs=[ATR_FILE],
+            inputs=["zx0boot.bin", "cloader.zx0", "config.com"] + config_tools(),
+            commands=[make_dist],
+            tools=[UPDATE_ATR],
+        ),
+    ]
+    # tools are rebuilt by make, only when missing
+    steps[0].key = lambda: "tools"
+    # resolve dependencies between steps
+    producers = {o: s for s in steps for o in s.outputs}
+    for s in steps:
+        used = s.inputs + s.tools
+        s.deps = sorted({producers[i].name for i in used if i in producers and producers[i] is not s})
+        if s.asm is not None and s.name != "tools":
+            s.deps = sorted(set(s.deps) | {"tools"})
+    return {s.name: s for s in steps}
+
+
+class Builder:
+
+    def __init__(self, steps, jobs, verbose=False, force=False):
+        self.steps = steps
+        self.jobs = jobs
+        self.verbose = verbose
+        self.force = force
+        self.lock = threading.Lock()
+        self.cache = {}
+        try:
+            with open(CACHE_FILE, 'r') as f:
+                self.cache = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+
+    def store(self, name, key):
+        with self.lock:
+            self.cache[name] = key
+            with open(CACHE_FILE, 'w') as f:
+                json.dump(self.cache, f, indent=1, sort_keys=True)
+
+
+    def report(self, step, output, ok, skipped=False):
+        # keep output of steps running in parallel together
+        with self.lock:
+            if skipped:
+                if self.verbose:
+                    print(f"Up to date: {step.name}")
+                return
+            print(step.text or f"Building {step.name}")
+            if output:
+                print(output, end="" if output.endswith("\n") else "\n")
+            if not ok:
+                print(f"Failed: {step.name}")
+            sys.stdout.flush()
+
+
+    def closure(self, targets):
+        names = []
+        todo = list(targets)
+        while todo:
+            name = todo.pop()
+            if name not in names:
+                names.append(name)
+                todo.extend(self.steps[name].deps)
+        return names
+
+
+    def run(self, targets):
+        pending = {n: self.steps[n] for n in self.closure(targets)}
+        done = set()
+        failed = False
+        with ThreadPoolExecutor(max_workers=self.jobs) as ex:
+            running = {}
+            while pending or running:
+                if not failed:
+                    for name, step in list(pending.items()):
+                        if len(running) >= self.jobs:
+                            break
+                        if all(d in done for d in step.deps):
+                            del pending[name]
+                            running[ex.submit(step.build, self)] = step
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for f in finished:
+                    step = running.pop(f)
+                    if f.result():
+                        done.add(step.name)
+                    else:
+                        failed = True
+        return not failed and not pending
+
+
+def clean():
+    for pattern in ["*.obj", "*.bin", "*.lst", "cloader.zx0", "config.com", ".build-cache.json"]:
+        for fn in glob.glob(os.path.join(SRC_DIR, pattern)):
+            os.unlink(fn)
+    if os.path.exists(ATR_FILE):
+        os.unlink(ATR_FILE)
+    shutil.rmtree(DIST_DIR, ignore_errors=True)
+
+
+def main():
+    o_verbose = False
+    o_force = False
+    o_overlap = False
+    o_compact = False
+    o_timing = False
+    o_burst = False
+    o_jobs = os.cpu_count() or 1
+    targets = []
+
+    args = sys.argv[1:]
+    while args:
+        arg = args.pop(0)
+        if arg == '-v':
+            o_verbose = True
+        elif arg == '-B':
+            o_force = True
+        elif arg == '--overlap':
+            o_overlap = True
+        elif arg == '--compact':
+            o_compact = True
+        elif arg == '--timing':
+            o_timing = True
+        elif arg == '--burst':
+            o_burst = True
+        elif arg.startswith('-j'):
+            try:
+                o_jobs = int(arg[2:] if len(arg) > 2 else args.pop(0))
+            except (ValueError, IndexError):
+                print("Option -j requires number of jobs")
+                sys.exit(1)
+        elif arg == '-h':
+            print_help()
+            sys.exit(0)
+        elif arg[0] == '-':
+            print(f'Unknown option: "{arg}"')
+            sys.exit(1)
+        else:
+            targets.append(arg)
+
+    if not targets:
+        targets = ["all"]
+    if "clean" in targets:
+        clean()
+        targets = [t for t in targets if t != "clean"]
+        if not targets:
+            return
+
+    if o_burst and o_overlap:
+        print("Options --burst and --overlap cannot be used together")
+        sys.exit(1)
+
+    steps = build_steps(o_overlap, o_compact, o_timing, o_burst)
+    expanded = []
+    for t in targets:
+        if t == "all":
+            expanded.extend(ALL)
+        elif t in steps:
+            expanded.append(t)
+        else:
+            print(f'Unknown target: "{t}"')
+            sys.exit(1)
+
+    if not Builder(steps, max(1, o_jobs), o_verbose, o_force).run(expanded):
+        sys.exit(1)
+
+
+def print_help():
+    print("""Content hashed parallel build for FujiNet Config Loader.
+Usage: build.py [options] [target ...]
+  all     Build boot loader, config loader, relocatable unpacker and compressed CONFIG (default)
+  dist    Build ATR disk image autorun-zx0.atr
+  clean   Remove build products and build cache
+  Any step name (e.g. cloader.zx0, zx0unpack) can be used as target too.
+Options:
+  -j N    Number of steps to run in parallel (default: number of CPUs)
+  -B      Rebuild all steps, ignore build cache
+  --overlap  Build config loader which reads next sector while current one
+          is decompressed (same as "make OVERLAP=1")
+  --compact  Use compact ZX0 decompressor in config loader and relocatable
+          unpacker instead of speed optimised one (same as "make ZX0COMPACT=1")
+  --timing   Build config loader which logs boot timeline to memory, see
+          tools/a8timing.py (same as "make TIMING=1")
+  --burst    Build config loader which reads CONFIG in bursts of sectors,
+          FujiNet, falls back to single sectors (same as "make BURST=1")
+  -v      Verbose output
+  -h      Print this help
+""")
+
+
+if __name__ == '__main__':
+    main()
@@ -53,6 +53,8 @@
 import sys
 import struct
 
+import a8mem
+
 
 REL_WORD = 0x80
 REL_HIGH = 0x40
@@ -136,9 +138,16 @@ def main():
         print("Files differs in size!")
         sys.exit(-1)
 
+    # relocation tables are placed into free memory, not used by any segment
+    memmap = a8mem.MemoryMap()
+    i = 2 if struct.unpack('<H', d1[0:2])[0] == 0xFFFF else 0
+    while i+4 < len(d1):
+        start1, end1 = struct.unpack('<HH', d1[i:i+4])
+        memmap.mark(start1, end1, "segment")
+        i += 5 + end1 - start1
+
     i = 0
     offset = 0
-    rel_start_next = 0x2000
     with open(fnout, 'wb') as fout:
         signature = struct.unpack('<H', d1[0:2])[0]
         if signature == 0xFFFF:
@@ -191,12 +200,12 @@ def main():
             fout.write(b'\x02')
 
             # segment header
-            if hdr_offset == 0:
-                rel_start = rel_start_next
-                rel_start_next += len(reltab)
-            else:
-                rel_start = start1 + ssize
-                rel_start_next = rel_start + len(reltab)
+            try:
+                rel_start = memmap.alloc(len(reltab), f"relocation table {start1:04X}")
+            except a8mem.LayoutError as e:
+                print(f"Cannot place relocation table: {e}")
+                sys.exit(-1)
+            print(f"relocation table at {rel_start:04X}")
             fout.write(struct.pack('<H', rel_start))
             fout.write(struct.pack('<H', rel_start + len(reltab) - 1))
             # relocation table
@@ -25,12 +25,16 @@ def atari_filename(fname):
     return (name+ext).upper().encode("ASCII")
 
 
+def sector_offset(sec):
+    return 16 + 128*(sec-1)
 
-def get_dentry(atr, fname):
+
+def find_dentry(atr, fname):
+    """Return offset of directory entry of file in ATR image, None if not found"""
     a8fname = atari_filename(fname)
     for sec in range(361, 369):
         for di in range(8):
-            dentry_offset = 16 + 128*(sec-1) + 16*di
+            dentry_offset = sector_offset(sec) + 16*di
             dentry = atr[dentry_offset:dentry_offset+16]
             flag = dentry[0]
             if flag == 0:
@@ -41,38 +45,27 @@ def get_dentry(atr, fname):
             dentry_fname = dentry[5:]
             # print(f"{flag:02X} {count:04X} {ssn:04X}", dentry_fname)
             if a8fname == dentry_fname:
-                dentry = atr[dentry_offset:dentry_offset+16]
-                return dentry
+                return dentry_offset
     return None
 
 
-def main():
-    if len(sys.argv) != 4:
-        print("Usage: update-atr.py atr_file loader_file loaded_file")
-        sys.exit(1)
-
-    atrfn = sys.argv[1]
-    loaderfn = sys.argv[2]
-    loadedfn = sys.argv[3]
+def get_dentry(atr, fname):
+    dentry_offset = find_dentry(atr, fname)
+    if dentry_offset is None:
+        return None
+    return atr[dentry_offset:dentry_offset+16]
 
-    try:
-        with open(atrfn, 'rb') as atrf:
-            atr = bytearray(atrf.read())
-    except Exception as e:
-        print(f'Failed to read "{atrfn}"')
-        print(e)
-        sys.exit(-1)
 
+def update_loader(atr, loaderfn, loadedfn):
+    """Store size and start sector of loaded file into loader file"""
     loader_dentry = get_dentry(atr, loaderfn)
     if loader_dentry is None:
-        print(f'Cannot find "{loaderfn}" in "{atrfn}"')
-        sys.exit(-1)
-    
+        raise ValueError(f'Cannot find "{loaderfn}"')
+
     loaded_dentry = get_dentry(atr, loadedfn)
     if loaded_dentry is None:
-        print(f'Cannot find "{loadedfn}" in "{atrfn}"')
-        sys.exit(-1)
-    
+        raise ValueError(f'Cannot find "{loadedfn}"')
+
     count, loader_ssn = struct.unpack('<HH', loader_dentry[1:5])
     print(f'Found "{loader_dentry[5:].decode("utf-8")}" {count} sectors, starting at sector {loader_ssn}')
     if loader_ssn != 4:
@@ -81,15 +74,80 @@ def main():
     count, loaded_ssn = struct.unpack('<HH', loaded_dentry[1:5])
     print(f'Found "{loaded_dentry[5:].decode("utf-8")}" {count} sectors, starting at sector {loaded_ssn}')
 
-    pbsf = 49 * 256 // (count - 2)
+    pbsf = 49 * 256 // max(1, count - 2)
     if pbsf > 255:
         print("Progress bar speed factor overflow. Loaded file is too small.")
         pbsf = 255
 
+    # sector count for burst reads, 0 = unknown
+    scnt = count if count < 256 else 0
+
     print("Updating ATR ...")
 
-    offset = 16 + 128*(loader_ssn-1) + 6
-    atr[offset:offset+3] = loaded_ssn & 0xFF, loaded_ssn >> 8, pbsf
+    offset = sector_offset(loader_ssn) + 6
+    atr[offset:offset+4] = scnt, loaded_ssn & 0xFF, loaded_ssn >> 8, pbsf
+
+
+def replace_file(atr, fname, data):
+    """Write new content of file into sectors it already has, return number of sectors
+
+    File can shrink but not grow, start sector is kept. Sectors no longer
+    used are freed in VTOC.
+    """
+    dentry_offset = find_dentry(atr, fname)
+    if dentry_offset is None:
+        raise ValueError(f'Cannot find "{fname}"')
+    count, ssn = struct.unpack_from('<HH', atr, dentry_offset+1)
+    # sectors of file, link is 10 bits
+    chain = []
+    sec = ssn
+    while sec and len(chain) < count:
+        chain.append(sec)
+        of = sector_offset(sec)
+        sec = (atr[of+125] & 3) << 8 | atr[of+126]
+    need = max(1, (len(data) + 124) // 125)
+    if need > len(chain):
+        raise ValueError(f'"{fname}" needs {need} sectors, it has {len(chain)}, rebuild ATR image')
+    fileno = atr[sector_offset(ssn)+125] >> 2
+    for i, sec in enumerate(chain[:need]):
+        of = sector_offset(sec)
+        chunk = data[125*i:125*(i+1)]
+        nxt = chain[i+1] if i+1 < need else 0
+        atr[of:of+125] = chunk + bytes(125-len(chunk))
+        atr[of+125:of+128] = (fileno << 2) | (nxt >> 8), nxt & 0xFF, len(chunk)
+    vtoc = sector_offset(360)
+    for sec in chain[need:]:
+        of = sector_offset(sec)
+        atr[of:of+128] = bytes(128)
+        atr[vtoc+10+sec//8] |= 0x80 >> (sec & 7)
+    free = struct.unpack_from('<H', atr, vtoc+3)[0]
+    struct.pack_into('<H', atr, vtoc+3, free + len(chain) - need)
+    struct.pack_into('<H', atr, dentry_offset+1, need)
+    return need
+
+
+def main():
+    if len(sys.argv) != 4:
+        print("Usage: update-atr.py atr_file loader_file loaded_file")
+        sys.exit(1)
+
+    atrfn = sys.argv[1]
+    loaderfn = sys.argv[2]
+    loadedfn = sys.argv[3]
+
+    try:
+        with open(atrfn, 'rb') as atrf:
+            atr = bytearray(atrf.read())
+    except Exception as e:
+        print(f'Failed to read "{atrfn}"')
+        print(e)
+        sys.exit(-1)
+
+    try:
+        update_loader(atr, loaderfn, loadedfn)
+    except ValueError as e:
+        print(f'{e} in "{atrfn}"')
+        sys.exit(-1)
 
     try:
         with open(atrfn, 'wb') as atrf:
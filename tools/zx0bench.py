@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+#  zx0bench.py - Cycle count benchmark of ZX0 decompressors
+#    runs unpacker builds on emulated 6502 over ZX0 packed segments of
+#    Atari DOS file, reports cycles per byte
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+#
+# Usage: zx0bench.py [options] unpacker.obj [unpacker.obj ...] file.com
+#        zx0bench.py --test unpacker.obj [unpacker.obj ...]
+#
+# Unpackers are non-relocatable builds of zx0unpack.src (e.g. src/zx0unpack-1000-f.obj
+# or src/zx0unpack-compact.obj). Every DATA segment of file.com is packed with
+# tools/pack/zx0 and decompressed to its own address by every unpacker, packed
+# data (with packed segment header) is placed at the top of free memory.
+# Only 6502 cycles are counted, GET_BYTE of unpacker included, no DMA.
+#
+# With --test generated segments are used instead of file.com, with matches
+# of 255, 256, 257 and 512 bytes (page boundaries of match copy loops). Then
+# a generated segment is split to chunks and hybridized as a8pack.py -d --chunk
+# does, loaded to memory as DOS does and its chunks are decompressed in place,
+# the test fails if packed data was moved or output is wrong. Hybridize needs
+# relocatable unpacker (make zx0unpack in src).
+#
+
+
+import sys
+import os
+import io
+import json
+import random
+import struct
+import tempfile
+import contextlib
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, TOOLS_DIR)
+import a8pack
+import a8mem
+from a8emu import CPU6502
+
+RETURN_TRAP = 0xFFF0            # unpacker returns here
+MAX_CYCLES = 100000000
+
+TEST_START = 0x2000             # address of generated segments
+TEST_MATCHES = (255, 256, 257, 512)
+TEST_CHUNK = 2048               # chunk size of generated segment packed in chunks
+
+
+class Unpacker:
+    """Non-relocatable build of zx0unpack.src"""
+
+    def __init__(self, filename):
+        self.name = os.path.basename(filename)
+        with contextlib.redirect_stdout(io.StringIO()):
+            obj = a8pack.AtariDosObject().load(filename)
+        self.code = None
+        self.entry = None
+        for s in obj.segments:
+            if s.type != a8pack.SEGMENT_DATA:
+                continue
+            if s.init_addr() is not None:
+                self.entry = s.init_addr()
+            elif self.code is None:
+                self.code = s
+        if self.code is None or self.entry is None:
+            raise ValueError(f'"{filename}" is not unpacker build')
+        self.start = self.code.start
+        self.end = self.code.end
+
+
+    def size(self):
+        return self.code.len()
+
+
+    def run(self, packed, decomp_to, length, mem=None, comp_data=None):
+        """Decompress packed to decomp_to, return (cycles, output)
+
+        Packed data is placed at the top of free memory, or it is already in mem
+        at comp_data (packed is None then).
+        """
+        if mem is None:
+            mem = bytearray(0x10000)
+        mem[self.start:self.end+1] = self.code.data
+        if decomp_to <= self.end and decomp_to + length > self.start:
+            raise ValueError(f"{self.name}: output {decomp_to:04X}-{decomp_to+length-1:04X} overlaps unpacker")
+        if comp_data is None:
+            comp_data = a8mem.MEMTOP + 1 - len(packed)
+            if comp_data <= max(self.end, decomp_to + length - 1):
+                raise ValueError(f"packed data at {comp_data:04X} overlaps unpacker or output")
+            mem[comp_data:comp_data+len(packed)] = packed
+        # DECOMP_TO and operand of LDA in GET_BYTE (COMP_DATA), see dzx0.src
+        mem[self.start:self.start+2] = struct.pack('<H', decomp_to)
+        mem[self.start+3:self.start+5] = struct.pack('<H', comp_data)
+
+        def write(addr, v):
+            mem[addr] = v
+
+        cpu = CPU6502(mem.__getitem__, write)
+        cpu.push_word(RETURN_TRAP - 1)
+        cpu.pc = self.entry
+        ops = cpu.ops
+        while cpu.pc != RETURN_TRAP:
+            if cpu.cycles > MAX_CYCLES:
+                raise RuntimeError(f"{self.name}: unpacker did not return")
+            opcode = mem[cpu.pc]
+            cpu.pc = (cpu.pc + 1) & 0xFFFF
+            op = ops[opcode]
+            if op is None:
+                raise RuntimeError(f"{self.name}: illegal opcode {opcode:02X} at {cpu.pc-1:04X}")
+            op()
+        return cpu.cycles, bytes(mem[decomp_to:decomp_to+length])
+
+
+def load_segments(filename):
+    """Return segments of file"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        obj = a8pack.AtariDosObject().load(filename)
+    return obj.segments
+
+
+def test_segments():
+    """Return segments with a block of random bytes repeated once, one match of block length"""
+    rnd = random.Random(0)
+    result = []
+    for n in TEST_MATCHES:
+        block = bytes(rnd.randrange(256) for _ in range(n))
+        data = block + block + bytes(rnd.randrange(256) for _ in range(16))
+        s = a8pack.Segment(a8pack.SEGMENT_DATA, TEST_START, TEST_START + len(data) - 1)
+        s.data = data
+        result.append(s)
+    return result
+
+
+def chunked_file():
+    """Return (segment, its chunks packed, hybrid file) of generated segment"""
+    rnd = random.Random(0)
+    s = a8pack.Segment(a8pack.SEGMENT_DATA, TEST_START, TEST_START + 4 * TEST_CHUNK - 1)
+    s.data = bytes(rnd.randrange(4) for _ in range(4 * TEST_CHUNK))
+    obj = a8pack.AtariDosObject()
+    obj.segments.append(s)
+    with contextlib.redirect_stdout(io.StringIO()):
+        packed = obj.split(TEST_CHUNK).pack(a8pack.PACK_ZX0)
+        hybrid = packed.hybridize()
+    return s, packed, hybrid
+
+
+def run_in_place(unpacker, s, packed, hybrid):
+    """Load hybrid file as DOS does, decompress its packed data in place in file order
+
+    Return (number of chunks decompressed, cycles).
+    """
+    lengths = {c.start: c.source.len() for c in packed.segments if c.type == a8pack.SEGMENT_PACKED}
+    mem = bytearray(0x10000)
+    unpack = []
+    segments = hybrid.segments
+    for i, h in enumerate(segments):
+        if h.type != a8pack.SEGMENT_DATA:
+            continue
+        if h.hint_byte() == 1:
+            # LOAD w/ UNPACK, packed data follows
+            start = h.run_addr()
+            s3 = segments[i+1]
+            if not start <= s3.start < start + lengths[start]:
+                raise RuntimeError(f"packed data of chunk {start:04X} moved to {s3.start:04X}")
+            unpack.append((start, lengths[start], s3.start))
+        elif h.hint_byte() is None and h.init_addr() is None and h.run_addr() is None:
+            mem[h.start:h.end+1] = h.data
+    if len(unpack) < 2:
+        raise RuntimeError(f"{len(unpack)} chunks of {s.start:04X}-{s.end:04X} hybridized, expected more")
+    cycles = 0
+    for start, length, comp_data in unpack:
+        c, _ = unpacker.run(None, start, length, mem, comp_data)
+        cycles += c
+    if mem[s.start:s.end+1] != s.data:
+        raise RuntimeError(f"{unpacker.name}: chunks of {s.start:04X}-{s.end:04X} decompressed incorrectly in place")
+    return len(unpack), cycles
+
+
+def pack_segments(segments):
+    """Return list of (segment, packed data) for DATA segments"""
+    result = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for s in segments:
+            if s.type != a8pack.SEGMENT_DATA or s.init_addr() is not None or s.run_addr() is not None:
+                continue
+            with contextlib.redirect_stdout(io.StringIO()):
+                s2 = s.pack(a8pack.PACK_ZX0, os.path.join(tmpdir, f"seg-{s.start:04X}"))
+            if s2 is None:
+                raise RuntimeError(f"failed to pack segment {s.start:04X}-{s.end:04X}")
+            result.append((s, s2.packed_header() + bytes(s2.data)))
+    return result
+
+
+def run_bench(unpackers, segments):
+    results = []
+    for u in unpackers:
+        r = {'unpacker': u.name, 'size': u.size(), 'bytes': 0, 'packed': 0, 'cycles': 0, 'segments': []}
+        for s, packed in segments:
+            cycles, out = u.run(packed, s.start, s.len())
+            if out != bytes(s.data):
+                raise RuntimeError(f"{u.name}: segment {s.start:04X}-{s.end:04X} decompressed incorrectly")
+            r['segments'].append({'start': s.start, 'end': s.end, 'packed': len(packed), 'cycles': cycles})
+            r['bytes'] += s.len()
+            r['packed'] += len(packed)
+            r['cycles'] += cycles
+        r['cycles_per_byte'] = round(r['cycles'] / r['bytes'], 2) if r['bytes'] else 0
+        results.append(r)
+    return results
+
+
+def print_results(results):
+    base = results[0]
+    for r in results:
+        print(f"{r['unpacker']}: {r['size']} bytes of code")
+        for seg in r['segments']:
+            n = 1 + seg['end'] - seg['start']
+            print(f"  {seg['start']:04X}-{seg['end']:04X} {n:6} bytes, packed {seg['packed']:6}"
+                f", {seg['cycles']:9} cycles, {seg['cycles']/n:6.2f} cycles/byte")
+        line = f"  total {r['bytes']} bytes, {r['cycles']} cycles, {r['cycles_per_byte']:.2f} cycles/byte"
+        if r is not base and r['cycles']:
+            line += f", {100*r['cycles']/base['cycles']:.1f}% of {base['unpacker']}"
+        print(line)
+
+
+def main():
+    o_json = None
+    o_test = False
+    files = []
+
+    args = sys.argv[1:]
+    while args:
+        arg = args.pop(0)
+        if arg == '--json':
+            if not args:
+                print(f'Option {arg} requires value')
+                sys.exit(1)
+            o_json = args.pop(0)
+        elif arg == '--test':
+            o_test = True
+        elif arg == '-h':
+            print_help()
+            sys.exit(0)
+        elif arg[0] == '-':
+            print(f'Unknown option: "{arg}"')
+            sys.exit(1)
+        else:
+            files.append(arg)
+
+    if len(files) < (1 if o_test else 2):
+        print_help()
+        sys.exit(1)
+
+    try:
+        if o_test:
+            unpackers = [Unpacker(fn) for fn in files]
+            segments = pack_segments(test_segments())
+        else:
+            unpackers = [Unpacker(fn) for fn in files[:-1]]
+            segments = pack_segments(load_segments(files[-1]))
+        results = run_bench(unpackers, segments)
+        if o_test:
+            chunked = chunked_file()
+            in_place = [run_in_place(u, *chunked) for u in unpackers]
+    except (OSError, ValueError, RuntimeError) as e:
+        print(e)
+        sys.exit(1)
+    print_results(results)
+    if o_test:
+        for u, (n, cycles) in zip(unpackers, in_place):
+            print(f"{u.name}: {n} chunks of {TEST_CHUNK} bytes decompressed in place, {cycles} cycles")
+    if o_json is not None:
+        with open(o_json, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+
+def print_help():
+    print("""Cycle count benchmark of ZX0 decompressors
+Usage: zx0bench.py [options] unpacker.obj [unpacker.obj ...] file.com
+       zx0bench.py --test unpacker.obj [unpacker.obj ...]
+  unpacker.obj  Non-relocatable unpacker build, first one is the reference
+  file.com      Atari DOS file, its DATA segments are packed and decompressed
+Options:
+  --test        Decompress generated segments with matches of 255, 256, 257
+                and 512 bytes instead of file.com, then chunks of generated
+                hybrid file in place, fail on moved packed data or wrong output
+  --json FILE   Write results to FILE
+  -h            Print this help
+""")
+
+
+if __name__ == '__main__':
+    main()